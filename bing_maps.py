@@ -23,13 +23,16 @@ import shutil
 import time
 import urllib.request
 
+import instrumentation
+
 # We're allowed 50000 requests in a 24 hour period.
 MIN_DELAY_BETWEEN_REQUESTS = datetime.timedelta(seconds=(24.0 * 60.0 * 60.0) / 50000)
 
 
 class BingMapsClient(object):
-    def __init__(self, api_key):
+    def __init__(self, api_key, stats=None):
         self.api_key = api_key
+        self.stats = stats if stats is not None else instrumentation.Stats()
 
         self._handshake()
         self.last_fetch = datetime.datetime.now()
@@ -40,15 +43,21 @@ class BingMapsClient(object):
 
         elapsed_between_requests = datetime.datetime.now() - self.last_fetch
         if elapsed_between_requests <= MIN_DELAY_BETWEEN_REQUESTS:
-            time.sleep((MIN_DELAY_BETWEEN_REQUESTS - elapsed_between_requests).total_seconds())
+            with self.stats.timer('throttle_sleep'):
+                time.sleep((MIN_DELAY_BETWEEN_REQUESTS - elapsed_between_requests).total_seconds())
 
         self.last_fetch = datetime.datetime.now()
-        (download_filename, headers) = urllib.request.urlretrieve(request_url)
+        with self.stats.timer('download'):
+            (download_filename, headers) = urllib.request.urlretrieve(request_url)
+
+        self.stats.incr('tiles_downloaded')
+        self.stats.incr('bytes_downloaded', os.path.getsize(download_filename))
 
         if 'X-MS-BM-WS-INFO' in headers:
             raise Exception('Exceeded rate limit.')
 
         if 'X-VE-Tile-Info' in headers and headers['X-VE-Tile-Info'] == 'no-tile':
+            self.stats.incr('no_tile_downloads')
             os.remove(download_filename)
 
             # Write an empty file to denote the absent tile.
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A local copy of the MapSwipe project list (projects.json), in SQLite (~/.mapswipe/catalogue.sqlite), indexed by
+# lookFor, state and progress, with each project's bounding box from projects.geojson.
+#
+# Syncing is incremental: if projects.json hasn't changed since the last sync, it isn't even parsed, and otherwise only
+# the projects that have changed are written. Once synced, the catalogue can be used offline.
+
+import argparse
+from collections import namedtuple
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import bing_maps
+import http_cache
+import mapswipe
+import project_index
+
+catalogue_path = os.path.join(mapswipe.working_dir_path, 'catalogue.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS projects (
+    project_id INTEGER PRIMARY KEY,
+    name TEXT,
+    look_for TEXT,
+    look_for_normalised TEXT,
+    progress INTEGER,
+    state INTEGER,
+    digest TEXT NOT NULL,
+    min_latitude REAL,
+    min_longitude REAL,
+    max_latitude REAL,
+    max_longitude REAL
+);
+CREATE INDEX IF NOT EXISTS projects_by_look_for ON projects (look_for_normalised, progress);
+CREATE INDEX IF NOT EXISTS projects_by_state ON projects (state);
+CREATE INDEX IF NOT EXISTS projects_by_progress ON projects (progress);
+CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+'''
+
+# Different projects describe the same thing in different ways.
+LOOK_FOR_SYNONYMS = {
+    'buildings only': 'buildings',
+    'roads only': 'roads',
+    'houses & roads': 'houses and roads',
+    'houses/roads': 'houses and roads'
+}
+
+STATES = {0: 'Not started', 1: 'On hold', 2: 'Complete', 3: 'Hidden'}
+
+Project = namedtuple('Project', ['project_id', 'name', 'look_for', 'look_for_normalised', 'progress', 'state',
+                                 'bounds'])
+
+
+def normalise_look_for(look_for):
+    if look_for is None:
+        return None
+
+    look_for = look_for.strip().lower()
+    return LOOK_FOR_SYNONYMS.get(look_for, look_for)
+
+
+class Catalogue(object):
+    def __init__(self, path=None):
+        self.path = path or catalogue_path
+
+        parent_path = os.path.dirname(self.path)
+        if not os.path.isdir(parent_path):
+            os.makedirs(parent_path)
+
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _get_setting(self, name):
+        row = self.connection.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_setting(self, name, value):
+        self.connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, value))
+
+    def sync(self, boundaries=True):
+        # Returns the number of projects added or changed, and the number removed.
+        body = http_cache.fetch(mapswipe.PROJECTS_URL)
+        digest = hashlib.sha1(body).hexdigest()
+
+        changed_count, removed_count = 0, 0
+        if digest != self._get_setting('projects_digest'):
+            changed_count, removed_count = self._sync_projects(json.loads(body.decode()))
+
+        # Boundaries come from projects.geojson, which is only needed (and fetched) to search by location.
+        if boundaries:
+            index = mapswipe.get_project_index(verbose=False)
+            if index.digest != self._get_setting('boundaries_digest'):
+                self._sync_boundaries(index)
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        self._set_setting('projects_digest', digest)
+        self._set_setting('synced_at', str(time.time()))
+        self.connection.execute('COMMIT')
+
+        return changed_count, removed_count
+
+    def _sync_projects(self, projects):
+        known_digests = dict(self.connection.execute('SELECT project_id, digest FROM projects'))
+
+        rows = []
+        for project_id, project_details in projects.items():
+            project_id = int(project_id)
+            digest = hashlib.sha1(json.dumps(project_details, sort_keys=True).encode()).hexdigest()
+            if known_digests.get(project_id) == digest:
+                continue
+
+            rows.append((project_id, project_details.get('name'), project_details.get('lookFor'),
+                         normalise_look_for(project_details.get('lookFor')), project_details.get('progress'),
+                         project_details.get('state'), digest))
+
+        removed = [(project_id,) for project_id in known_digests.keys() - {int(x) for x in projects.keys()}]
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        # Upserting keeps the bounding boxes of projects whose details have changed.
+        self.connection.executemany(
+            'INSERT INTO projects (project_id, name, look_for, look_for_normalised, progress, state, digest) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (project_id) DO UPDATE SET name = excluded.name, '
+            'look_for = excluded.look_for, look_for_normalised = excluded.look_for_normalised, '
+            'progress = excluded.progress, state = excluded.state, digest = excluded.digest', rows)
+        self.connection.executemany('DELETE FROM projects WHERE project_id = ?', removed)
+        if rows or removed:
+            # New projects have no bounding boxes yet, so the next sync with boundaries has to fill them in.
+            self.connection.execute("DELETE FROM settings WHERE name = 'boundaries_digest'")
+        self.connection.execute('COMMIT')
+
+        return len(rows), len(removed)
+
+    def _sync_boundaries(self, index):
+        rows = []
+        for (project_id,) in self.connection.execute('SELECT project_id FROM projects').fetchall():
+            if project_id not in index.bounds:
+                rows.append((None, None, None, None, project_id))
+                continue
+
+            min_x, min_y, max_x, max_y = index.bounds[project_id]
+            north, west = bing_maps.pixel_to_latlong((min_x, min_y), project_index.LEVEL_OF_DETAIL)
+            south, east = bing_maps.pixel_to_latlong((max_x, max_y), project_index.LEVEL_OF_DETAIL)
+            rows.append((south, west, north, east, project_id))
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany('UPDATE projects SET min_latitude = ?, min_longitude = ?, max_latitude = ?, '
+                                    'max_longitude = ? WHERE project_id = ?', rows)
+        self._set_setting('boundaries_digest', index.digest)
+        self.connection.execute('COMMIT')
+
+    def is_empty(self):
+        return self._get_setting('projects_digest') is None
+
+    def synced_at(self):
+        synced_at = self._get_setting('synced_at')
+        return float(synced_at) if synced_at else None
+
+    def find_projects(self, look_for=None, state=None, min_progress=None, within=None, named_only=True):
+        # within is a lat/long box (south, west, north, east), and matches projects whose bounding boxes intersect it.
+        conditions, parameters = [], []
+        if look_for is not None and look_for != 'all':
+            conditions.append('look_for_normalised = ?')
+            parameters.append(normalise_look_for(look_for))
+        if state is not None:
+            conditions.append('state = ?')
+            parameters.append(state)
+        if min_progress is not None:
+            conditions.append('progress >= ?')
+            parameters.append(min_progress)
+        if within is not None:
+            conditions.append('min_latitude <= ? AND max_latitude >= ? AND min_longitude <= ? AND max_longitude >= ?')
+            parameters.extend([within[2], within[0], within[3], within[1]])
+        if named_only:
+            conditions.append('name IS NOT NULL')
+
+        query = 'SELECT project_id, name, look_for, look_for_normalised, progress, state, min_latitude, ' \
+                'min_longitude, max_latitude, max_longitude FROM projects'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY project_id'
+
+        return [Project(*row[:6], bounds=None if row[6] is None else tuple(row[6:]))
+                for row in self.connection.execute(query, parameters)]
+
+    def look_for_counts(self, normalised=False):
+        column = 'look_for_normalised' if normalised else 'look_for'
+        return dict(self.connection.execute(
+            'SELECT {0}, COUNT(*) FROM projects WHERE {0} IS NOT NULL GROUP BY {0}'.format(column)))
+
+
+def open_catalogue(offline=False, boundaries=False):
+    # Returns an up to date catalogue, or with offline, whatever was there after the last sync. Project boundaries are
+    # only synced with boundaries, i.e. when the caller is going to search by location.
+    catalogue = Catalogue()
+
+    if not offline:
+        catalogue.sync(boundaries=boundaries)
+    elif catalogue.is_empty():
+        raise Exception('The project catalogue at {} is empty. Run once without --offline to fill it.'.format(
+            catalogue.path))
+
+    return catalogue
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('sync', help='Bring the catalogue up to date with the MapSwipe API')
+    subparsers.add_parser('status', help='Summarise the catalogue')
+
+    args = parser.parse_args(argv)
+
+    catalogue = Catalogue()
+    if args.command == 'sync':
+        changed_count, removed_count = catalogue.sync()
+        print('{} projects added or changed, {} removed'.format(changed_count, removed_count))
+    else:
+        if catalogue.is_empty():
+            print('The catalogue is empty')
+        else:
+            print('{} projects, last synced {}'.format(len(catalogue.find_projects(named_only=False)),
+                                                     time.ctime(catalogue.synced_at())))
+    catalogue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Checkpointing that doesn't stall training. At the end of each epoch the model's weights are copied into memory, and a
+# background thread writes them out (as .weights.npz files, without the optimizer state) along with a line of the fit
+# history. Only the best few checkpoints by val_loss, plus the latest one, are kept. Whenever the best checkpoint changes,
+# it's also saved as a normal Keras model (without the optimizer state), so that it can be used with test.py even if
+# training is interrupted.
+#
+# With store_deltas, the first checkpoint is kept in full and every later one only stores the bitwise XOR of its weights
+# with the first one's. These are compressed, which is a big saving when most of the layers are frozen (e.g. when fine
+# tuning), and unlike a subtraction, the weights come back exactly.
+
+import json
+import math
+import os
+import queue
+import shutil
+import threading
+
+import h5py
+import numpy as np
+from keras import callbacks
+
+
+def load_weights(path):
+    with np.load(path) as checkpoint:
+        weights = [checkpoint['w{}'.format(i)] for i in range(int(checkpoint['weight_count']))]
+        base_filename = str(checkpoint['base']) if 'base' in checkpoint else None
+
+    if base_filename:
+        base_weights = load_weights(os.path.join(os.path.dirname(path), base_filename))
+        weights = [(raw_bits(base) ^ delta).view(base.dtype) for base, delta in zip(base_weights, weights)]
+
+    return weights
+
+
+def raw_bits(array):
+    return array.view(np.dtype('u{}'.format(array.dtype.itemsize)))
+
+
+def checkpoint_order(checkpoint):
+    # Best first, by the monitored value (with NaN as the worst possible), then by epoch.
+    value, epoch = checkpoint[0], checkpoint[1]
+    return (float('inf') if math.isnan(value) else value), epoch
+
+
+class AsyncCheckpointManager(callbacks.Callback):
+    def __init__(self, output_dir, prefix, keep_top_k=3, store_deltas=False, monitor='val_loss'):
+        super().__init__()
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.keep_top_k = keep_top_k
+        self.store_deltas = store_deltas
+        self.monitor = monitor
+
+        self.history_path = os.path.join(output_dir, prefix + '_fit_history.jsonl')
+        self.template_path = os.path.join(output_dir, prefix + '.template.hdf5')
+        self.checkpoints = []  # (monitored value, epoch, path, logs)
+        self.best_model_path = None
+        self.base_filename = None
+        self.base_weights = None
+
+        # At most one snapshot waits to be written, so a slow disk can't make us hold lots of copies of the model.
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = None
+
+    def on_train_begin(self, logs=None):
+        # The best model is written by copying this file and replacing the weights in the copy, since the model itself
+        # can't be used from the writer thread.
+        self.model.save(self.template_path, include_optimizer=False)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._raise_if_failed()
+        self._queue.put((epoch + 1, dict(logs or {}), self.model.get_weights()))
+
+    def on_train_end(self, logs=None):
+        self._queue.put(None)
+        self._thread.join()
+
+        if os.path.exists(self.template_path):
+            os.remove(self.template_path)
+
+        self._raise_if_failed()
+
+    def checkpoint_name(self, epoch, logs):
+        return '{}.{:02d}-{:.3f}-{:.3f}'.format(self.prefix, epoch, logs.get('val_loss', float('nan')),
+                                                logs.get('val_categorical_accuracy', float('nan')))
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise Exception('Writing a checkpoint failed') from self._error
+
+    def _run(self):
+        try:
+            while True:
+                snapshot = self._queue.get()
+                if snapshot is None:
+                    return
+
+                self._write_checkpoint(*snapshot)
+        except Exception as e:
+            self._error = e
+
+            # Keep draining the queue, so that training fails at the end of the next epoch rather than hanging.
+            while self._queue.get() is not None:
+                pass
+
+    def _write_checkpoint(self, epoch, logs, weights):
+        with open(self.history_path, 'a') as history_file:
+            history_file.write(json.dumps(dict({'epoch': epoch}, **{k: float(v) for k, v in logs.items()})) + '\n')
+
+        path = os.path.join(self.output_dir, self.checkpoint_name(epoch, logs) + '.weights.npz')
+        arrays = {'w{}'.format(i): w for i, w in enumerate(weights)}
+        arrays['weight_count'] = np.array(len(weights))
+
+        if not self.store_deltas:
+            np.savez(path, **arrays)
+        else:
+            if self.base_weights is None:
+                self.base_filename = self.prefix + '.base.weights.npz'
+                self.base_weights = weights
+                np.savez(os.path.join(self.output_dir, self.base_filename), **arrays)
+
+            deltas = {'w{}'.format(i): raw_bits(w) ^ raw_bits(base)
+                      for i, (w, base) in enumerate(zip(weights, self.base_weights))}
+            np.savez_compressed(path, base=np.array(self.base_filename), weight_count=arrays['weight_count'], **deltas)
+
+        checkpoint = (float(logs.get(self.monitor, float('inf'))), epoch, path, logs)
+        self.checkpoints.append(checkpoint)
+
+        if min(self.checkpoints, key=checkpoint_order) is checkpoint:
+            self._write_best_model(epoch, logs, weights)
+
+        self._prune()
+
+    def _write_best_model(self, epoch, logs, weights):
+        path = os.path.join(self.output_dir, self.checkpoint_name(epoch, logs) + '.hdf5')
+        temp_path = path + '.tmp'
+
+        shutil.copyfile(self.template_path, temp_path)
+        with h5py.File(temp_path, 'r+') as f:
+            # Keras saves each layer's weights in the same order as get_weights() returns them.
+            group = f['model_weights']
+            weights = iter(weights)
+            for layer_name in group.attrs['layer_names']:
+                layer_group = group[_decode(layer_name)]
+                for weight_name in layer_group.attrs['weight_names']:
+                    layer_group[_decode(weight_name)][...] = next(weights)
+
+        os.replace(temp_path, path)
+
+        if self.best_model_path is not None and self.best_model_path != path and os.path.exists(self.best_model_path):
+            os.remove(self.best_model_path)
+        self.best_model_path = path
+
+    def _prune(self):
+        latest = max(self.checkpoints, key=lambda x: x[1])
+        best = sorted(self.checkpoints, key=checkpoint_order)[:self.keep_top_k]
+
+        keep = best + ([latest] if latest not in best else [])
+        for checkpoint in self.checkpoints:
+            if checkpoint not in keep and os.path.exists(checkpoint[2]):
+                os.remove(checkpoint[2])
+
+        self.checkpoints = keep
+
+
+def _decode(name):
+    return name.decode('utf8') if isinstance(name, bytes) else name
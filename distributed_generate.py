@@ -0,0 +1,404 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Splits the work of generate_dataset.py across many worker processes (and Bing Maps keys). There are three steps:
+#
+#   plan    Selects and shuffles the candidate tiles for each project, exactly as generate_dataset.py does, and splits
+#           them into work units by quadkey prefix, in a SQLite queue.
+#   work    Claims work units from the queue, and downloads their tiles into the tile cache. Run as many of these as you
+#           like, each with its own Bing Maps key.
+#   merge   Replays generate_dataset.py's tile selection against the downloaded tiles, and writes the result as a
+#           manifest (and optionally as a dataset).
+#
+# To save Bing Maps quota, plan only queues a few more candidates of each class than each project looks likely to need.
+# If a project's selection runs into candidates that haven't been downloaded, merge queues some more of them instead, and
+# the workers and merge are run again. The manifest only depends on the plan, so it's the same however the work was
+# split up, and the same as generate_dataset.py's.
+
+import argparse
+import collections
+import csv
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+import bing_maps
+import generate_dataset
+import instrumentation
+import labelling
+import mapswipe
+from proportional_allocator import ProportionalAllocator
+import shards
+import tile_cache
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS projects (position INTEGER PRIMARY KEY, project_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS work_units (
+    id INTEGER PRIMARY KEY,
+    project_id INTEGER NOT NULL,
+    prefix TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed_at REAL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS candidates (
+    project_id INTEGER NOT NULL,
+    quadkey TEXT NOT NULL,
+    tile_class TEXT NOT NULL,
+    pick_order INTEGER NOT NULL,
+    unit_id INTEGER,
+    available INTEGER,
+    PRIMARY KEY (project_id, quadkey)
+);
+CREATE INDEX IF NOT EXISTS candidates_by_unit ON candidates (unit_id);
+CREATE INDEX IF NOT EXISTS work_units_by_status ON work_units (status, id);
+'''
+
+
+def connect(queue_path):
+    connection = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def plan(args):
+    if os.path.exists(args.queue):
+        raise Exception('Queue {} already exists.'.format(args.queue))
+
+    connection = connect(args.queue)
+    connection.execute('BEGIN')
+    connection.executemany('INSERT INTO settings VALUES (?, ?)',
+                           [('seed', str(args.seed)), ('max_size', str(args.max_size)),
+                            ('oversample', str(args.oversample)), ('prefix_length', str(args.prefix_length)),
+                            ('label_rule', labelling.format_rule(args.label_rule))])
+
+    stats = instrumentation.Stats()
+    project_index = mapswipe.get_project_index()
+    used_project_ids = set()
+    remaining_tile_groups = args.max_size
+
+    for position, project_id in enumerate(args.project_ids):
+        connection.execute('INSERT INTO projects VALUES (?, ?)', (position, project_id))
+
+        print('Selecting tiles from project (#{})... '.format(project_id))
+        fresh_project_tiles = generate_dataset.select_fresh_tiles(project_id, project_index, used_project_ids, stats)
+        candidates = generate_dataset.classify_project_tiles(project_id, fresh_project_tiles, stats,
+                                                              args.label_rule)
+        used_project_ids.add(project_id)
+
+        shuffled_candidates = generate_dataset.shuffle_candidates(candidates, args.seed)
+
+        # A project can't give more tile groups than its smallest class has tiles, nor more than --max-size has room
+        # for after the earlier projects, so only download a few more tiles of each class than that to begin with. Some
+        # tiles have no imagery, hence the oversampling. If that's not enough, merge queues more.
+        tile_group_limit = min(min(len(tiles) for tiles in shuffled_candidates), max(remaining_tile_groups, 0))
+        remaining_tile_groups -= tile_group_limit
+        candidate_limit = tile_group_limit * args.oversample
+
+        for tile_class, tiles in zip(generate_dataset.tile_classes, shuffled_candidates):
+            # generate_dataset.py pops tiles off the end of the shuffled lists.
+            connection.executemany('INSERT INTO candidates (project_id, quadkey, tile_class, pick_order) '
+                                   'VALUES (?, ?, ?, ?)', ((project_id, quadkey, tile_class, pick_order)
+                                                           for pick_order, quadkey in enumerate(reversed(tiles))))
+
+        queued = {tile_class: candidate_limit for tile_class in generate_dataset.tile_classes}
+        unit_count, tile_counts = queue_candidates(connection, project_id, queued, args.prefix_length)
+
+        print('\t{} candidate tiles in {} work units ({})'.format(
+            sum(tile_counts.values()), unit_count,
+            ', '.join('{}: {}'.format(tile_class, tile_counts[tile_class]) for tile_class in generate_dataset.tile_classes)))
+
+    connection.execute('COMMIT')
+
+
+def queue_candidates(connection, project_id, counts, prefix_length):
+    # Puts the next counts[tile_class] candidates of each class, in pick order, that aren't in a work unit yet into new
+    # work units. Returns the number of work units, and the number of tiles of each class queued.
+    units = {}
+    tile_counts = {}
+    for tile_class, count in counts.items():
+        quadkeys = [row[0] for row in connection.execute(
+            'SELECT quadkey FROM candidates WHERE project_id = ? AND tile_class = ? AND unit_id IS NULL '
+            'ORDER BY pick_order LIMIT ?', (project_id, tile_class, count))]
+
+        for quadkey in quadkeys:
+            prefix = quadkey[:prefix_length]
+            if prefix not in units:
+                units[prefix] = connection.execute('INSERT INTO work_units (project_id, prefix) VALUES (?, ?)',
+                                                   (project_id, prefix)).lastrowid
+
+            connection.execute('UPDATE candidates SET unit_id = ? WHERE project_id = ? AND quadkey = ?',
+                               (units[prefix], project_id, quadkey))
+        tile_counts[tile_class] = len(quadkeys)
+
+    return len(units), tile_counts
+
+
+def claim_work_unit(connection, worker, lease_seconds):
+    # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same unit.
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        row = connection.execute(
+            "SELECT id, project_id, prefix FROM work_units WHERE status = 'pending' OR "
+            "(status = 'claimed' AND claimed_at < ?) ORDER BY id LIMIT 1", (time.time() - lease_seconds,)).fetchone()
+
+        if row is not None:
+            connection.execute("UPDATE work_units SET status = 'claimed', worker = ?, claimed_at = ? WHERE id = ?",
+                               (worker, time.time(), row[0]))
+        connection.execute('COMMIT')
+    except:
+        connection.execute('ROLLBACK')
+        raise
+
+    return row
+
+
+def work(args):
+    connection = connect(args.queue)
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    stats = instrumentation.Stats()
+    bing_maps_client = bing_maps.BingMapsClient(args.bing_maps_key, stats)
+    tile_index = tile_cache.TileCacheIndex()
+
+    units_done = 0
+    while True:
+        work_unit = claim_work_unit(connection, worker, args.lease_minutes * 60)
+        if work_unit is None:
+            break
+
+        unit_id, project_id, prefix = work_unit
+        quadkeys = [row[0] for row in connection.execute(
+            'SELECT quadkey FROM candidates WHERE unit_id = ? ORDER BY quadkey', (unit_id,))]
+
+        availability = [(int(generate_dataset.probe_tile(quadkey, bing_maps_client, stats, tile_index)), project_id, quadkey)
+                        for quadkey in quadkeys]
+
+        connection.execute('BEGIN IMMEDIATE')
+        connection.executemany('UPDATE candidates SET available = ? WHERE project_id = ? AND quadkey = ?',
+                               availability)
+        connection.execute("UPDATE work_units SET status = 'done', finished_at = ? WHERE id = ?",
+                           (time.time(), unit_id))
+        connection.execute('COMMIT')
+
+        units_done += 1
+        print('{}: unit {} (#{}, {}) done, {} tiles. {}'.format(
+            worker, unit_id, project_id, prefix, len(quadkeys), stats.summary_line()))
+
+    print('{}: no more work units ({} done)'.format(worker, units_done))
+    tile_index.close()
+
+    if args.stats_file:
+        stats.write_json(args.stats_file)
+
+
+def select_tile_groups(connection, shortfalls=None):
+    # Replays generate_dataset.main()'s selection loop, with the tile cache lookups replaced by the workers' results.
+    # A project's selection stops early if it gets to a candidate that hasn't been downloaded. If shortfalls is a dict,
+    # then for each project where that happened, it's given how many more available tiles of each class the project
+    # could still need.
+    settings = dict(connection.execute('SELECT name, value FROM settings'))
+    max_size = int(settings['max_size'])
+
+    total_tile_groups_written = 0
+    for (project_id,) in connection.execute('SELECT project_id FROM projects ORDER BY position').fetchall():
+        if total_tile_groups_written >= max_size:
+            break
+
+        allocator = ProportionalAllocator(generate_dataset.classes_and_proportions)
+
+        pools = collections.OrderedDict((tile_class, []) for tile_class in generate_dataset.tile_classes)
+        for tile_class, quadkey, available in connection.execute(
+                'SELECT tile_class, quadkey, available FROM candidates WHERE project_id = ? '
+                'ORDER BY pick_order DESC', (project_id,)):
+            pools[tile_class].append((quadkey, available))
+
+        while all(pools.values()) and total_tile_groups_written < max_size:
+            samples = [pick_available(pool) for pool in pools.values()]
+
+            if NOT_DOWNLOADED in samples:
+                if shortfalls is not None:
+                    # Every tile group still to come needs one available tile of each class.
+                    needed = min(max_size - total_tile_groups_written, min(len(pool) for pool in pools.values()) + 1)
+                    shortfalls[project_id] = {
+                        tile_class: max(needed - sum(1 for _, available in pool if available), 0)
+                        for tile_class, pool in pools.items()}
+                break
+
+            if None not in samples:
+                total_tile_groups_written += 1
+                yield project_id, allocator.allocate(), samples
+
+
+NOT_DOWNLOADED = object()
+
+
+def pick_available(pool):
+    while pool:
+        quadkey, available = pool.pop()
+        if available is None:
+            return NOT_DOWNLOADED
+        if available:
+            return quadkey
+
+    return None
+
+
+def merge(args):
+    connection = connect(args.queue)
+
+    unfinished = connection.execute("SELECT COUNT(*) FROM work_units WHERE status != 'done'").fetchone()[0]
+    if unfinished:
+        raise Exception('{} work units have not been finished yet.'.format(unfinished))
+
+    shortfalls = {}
+    tile_groups = list(select_tile_groups(connection, shortfalls))
+
+    if shortfalls:
+        settings = dict(connection.execute('SELECT name, value FROM settings'))
+        oversample = int(settings.get('oversample', 2))
+
+        connection.execute('BEGIN IMMEDIATE')
+        unit_count = 0
+        for project_id, shortfall in shortfalls.items():
+            unit_count += queue_candidates(connection, project_id, {tile_class: count * oversample
+                                                                    for tile_class, count in shortfall.items()},
+                                           int(settings.get('prefix_length', 12)))[0]
+        connection.execute('COMMIT')
+
+        print('{} projects need more tiles than have been downloaded, so {} more work units have been queued. Run the '
+              'workers again, and then merge.'.format(len(shortfalls), unit_count))
+        return
+
+    with open(args.manifest, 'w', newline='') as manifest_file:
+        manifest = csv.writer(manifest_file)
+        manifest.writerow(['project_id', 'subset', 'tile_class', 'quadkey'])
+        for project_id, clazz, samples in tile_groups:
+            for tile_class, quadkey in zip(generate_dataset.tile_classes, samples):
+                manifest.writerow([project_id, clazz, tile_class, quadkey])
+
+    print('Wrote {} tile groups to {}'.format(len(tile_groups), os.path.abspath(args.manifest)))
+
+    # Keep the manifest's tiles in the tile cache for as long as the manifest exists.
+    tile_index = tile_cache.TileCacheIndex()
+    tile_index.register_manifest(args.manifest)
+    tile_index.close()
+
+    if args.output_dir:
+        if os.path.exists(args.output_dir):
+            raise Exception('Directory {} already exists.'.format(args.output_dir))
+
+        # Every worker downloaded into its own tile cache, so they need to have been gathered into this machine's (or
+        # be on a shared filesystem) by now.
+        missing = [quadkey for _, _, samples in tile_groups for quadkey in samples
+                   if not os.path.isfile(mapswipe.get_tile_path(quadkey, make_directories=False))]
+        if missing:
+            raise Exception('{} tiles (e.g. {}) are missing from the tile cache at {}.'.format(
+                len(missing), missing[0], mapswipe.tile_cache_path))
+
+        inner_test_dir = 'test/test' if args.inner_test_dir_for_keras else 'test'
+        dataset_writer = generate_dataset.DatasetWriter(args.output_dir, args.format, inner_test_dir,
+                                                        args.shard_size * 2 ** 20)
+        for _, clazz, samples in tile_groups:
+            dataset_writer.write_group(clazz, samples)
+        dataset_writer.close()
+
+        if args.format == 'symlinks':
+            # The manifest pins the same tiles, but only for as long as it exists, and the symlinks need them too.
+            tile_index = tile_cache.TileCacheIndex()
+            tile_index.register_manifest(args.output_dir)
+            tile_index.close()
+
+        print('Wrote dataset to {}'.format(os.path.abspath(args.output_dir)))
+
+
+def status(args):
+    connection = connect(args.queue)
+
+    for unit_status, unit_count, tile_count in connection.execute(
+            'SELECT w.status, COUNT(DISTINCT w.id), COUNT(c.quadkey) FROM work_units w '
+            'LEFT JOIN candidates c ON c.unit_id = w.id GROUP BY w.status ORDER BY w.status'):
+        print('{}: {} work units ({} tiles)'.format(unit_status, unit_count, tile_count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    plan_parser = subparsers.add_parser('plan', help='Create a work queue for generating a dataset')
+    plan_parser.add_argument('project_ids', metavar='<project_id>', type=int, nargs='+',
+                             help='Project IDs to use to generate the dataset.')
+    plan_parser.add_argument('--queue', '-q', metavar='<queue_file>', required=True,
+                             help='The SQLite work queue to create.')
+    plan_parser.add_argument('--seed', '-s', metavar='<random_seed>', default=0, type=int,
+                             help='The random seed to use when picking tiles. Default: 0.')
+    plan_parser.add_argument('--max-size', '-n', metavar='<class_size>', default=sys.maxsize, type=int,
+                             help='The maximum total number of items per class to output.')
+    plan_parser.add_argument('--prefix-length', '-l', metavar='<length>', default=12, type=int,
+                             help='Candidate tiles are grouped into work units by the first <length> characters of '
+                                  'their quadkeys. Default: 12 (i.e. blocks of up to 64x64 tiles).')
+    plan_parser.add_argument('--oversample', metavar='<factor>', default=2, type=int,
+                             help='Only download up to <factor> times as many tiles of each class as could possibly '
+                                  'be used. Default: 2.')
+    plan_parser.add_argument('--label-rule', '-r', metavar='<rule>', default=labelling.DEFAULT_RULE,
+                             type=labelling.parse_rule,
+                             help='How to decide which tiles are built and bad_imagery from their votes. See '
+                                  'labelling.py.')
+
+    work_parser = subparsers.add_parser('work', help='Download tiles for work units until the queue is empty')
+    work_parser.add_argument('--queue', '-q', metavar='<queue_file>', required=True, help='The SQLite work queue.')
+    work_parser.add_argument('--bing-maps-key', '-k', metavar='<bing_maps_api_key>', required=True,
+                             help='Bing Maps API key to use to download map tiles.')
+    work_parser.add_argument('--lease-minutes', metavar='<minutes>', default=60, type=float,
+                             help='Work units claimed by another worker more than this long ago (which presumably '
+                                  'died) are taken over. Default: 60.')
+    work_parser.add_argument('--stats-file', metavar='<stats_file>', default=None,
+                             help='Write a JSON timing report to this file when the worker finishes.')
+
+    merge_parser = subparsers.add_parser('merge', help='Select the dataset from the downloaded tiles')
+    merge_parser.add_argument('--queue', '-q', metavar='<queue_file>', required=True, help='The SQLite work queue.')
+    merge_parser.add_argument('--manifest', '-m', metavar='<manifest_file>', default='manifest.csv',
+                              help='The CSV manifest to write. Default: manifest.csv.')
+    merge_parser.add_argument('--output-dir', '-o', metavar='<output_directory>', default=None,
+                              help='Also write the dataset to this directory (needs all of the tiles in the local '
+                                   'tile cache).')
+    merge_parser.add_argument('--format', '-f', choices=['symlinks', 'shards'], default='symlinks',
+                              help='The dataset format, as for generate_dataset.py. Default: symlinks.')
+    merge_parser.add_argument('--shard-size', metavar='<megabytes>', default=shards.DEFAULT_SHARD_SIZE // 2 ** 20,
+                              type=int, help='The maximum size of each shard, when using --format shards. '
+                                             'Default: {}.'.format(shards.DEFAULT_SHARD_SIZE // 2 ** 20))
+    merge_parser.add_argument('--inner-test-dir-for-keras', action='store_true',
+                              help='Create an extra directory inside the test directory (useful when working with '
+                                   'Keras)')
+
+    status_parser = subparsers.add_parser('status', help='Summarise the progress of the work queue')
+    status_parser.add_argument('--queue', '-q', metavar='<queue_file>', required=True, help='The SQLite work queue.')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'plan' and args.oversample < 1:
+        parser.error('--oversample must be at least 1')
+
+    {'plan': plan, 'work': work, 'merge': merge, 'status': status}[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import os
+
+import inference
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', '-m', required=True, metavar='<model_file>',
+                        help='Keras model (HDF5 checkpoint) to export')
+    parser.add_argument('--output', '-o', required=True, metavar='<output_file>',
+                        help='Exported model path. The format is chosen by extension: .tflite for a TensorFlow Lite '
+                             'model, or .pb for a frozen TensorFlow graph.')
+    parser.add_argument('--quantise', '-q', choices=inference.QUANTISATION_TYPES, default=None,
+                        help='Store the weights at reduced precision (.tflite only).')
+
+    args = parser.parse_args(argv)
+
+    inference.export_model(args.model, args.output, args.quantise)
+
+    print('Exported {} ({:.1f}MB) to {} ({:.1f}MB)'.format(
+        args.model, os.path.getsize(args.model) / 2 ** 20, args.output, os.path.getsize(args.output) / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A stand-in for the MapSwipe API, which replays recorded responses. Recordings are stored as
+# <fixtures_dir>/<host>/<path>, e.g. fixtures/api.mapswipe.org/projects.json.
+#
+# Record:   ./fixture_server.py record fixtures http://api.mapswipe.org/projects.json ...
+# Replay:   ./fixture_server.py serve fixtures --port 8643
+#           MAPSWIPE_HTTP_FIXTURES=http://127.0.0.1:8643 ./list_projects.py buildings
+
+import argparse
+import email.utils
+import http.server
+import os
+import shutil
+import threading
+import urllib.parse
+import urllib.request
+
+
+def fixture_path(fixtures_dir, url):
+    parsed_url = urllib.parse.urlparse(url)
+    return os.path.join(fixtures_dir, parsed_url.netloc, parsed_url.path.lstrip('/'))
+
+
+def record(fixtures_dir, url):
+    destination_path = fixture_path(fixtures_dir, url)
+
+    parent_path = os.path.dirname(destination_path)
+    if not os.path.isdir(parent_path):
+        os.makedirs(parent_path)
+
+    (download_filename, headers) = urllib.request.urlretrieve(url)
+    shutil.move(download_filename, destination_path)
+
+    return destination_path
+
+
+def make_request_handler(fixtures_dir):
+    class FixtureRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = os.path.normpath(os.path.join(fixtures_dir, urllib.parse.urlparse(self.path).path.lstrip('/')))
+            if not path.startswith(os.path.abspath(fixtures_dir) + os.sep) or not os.path.isfile(path):
+                self.send_error(404, 'No recording for {}'.format(self.path))
+                return
+
+            stat = os.stat(path)
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+            if self.headers.get('If-None-Match') == etag or \
+                    (self.headers.get('If-None-Match') is None and
+                     self.headers.get('If-Modified-Since') == last_modified):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Length', str(stat.st_size))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FixtureRequestHandler
+
+
+def start(fixtures_dir, host='127.0.0.1', port=0):
+    fixtures_dir = os.path.abspath(fixtures_dir)
+    server = http.server.ThreadingHTTPServer((host, port), make_request_handler(fixtures_dir))
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def server_url(server):
+    return 'http://{}:{}'.format(*server.server_address[:2])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser('record', help='Record responses from the live API')
+    record_parser.add_argument('fixtures_dir', metavar='<fixtures_dir>')
+    record_parser.add_argument('urls', metavar='<url>', nargs='+')
+
+    serve_parser = subparsers.add_parser('serve', help='Replay recorded responses')
+    serve_parser.add_argument('fixtures_dir', metavar='<fixtures_dir>')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default: 127.0.0.1')
+    serve_parser.add_argument('--port', '-p', default=8643, type=int, help='Port to listen on. Default: 8643')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        for url in args.urls:
+            print('{} -> {}'.format(url, record(args.fixtures_dir, url)))
+    else:
+        server = start(args.fixtures_dir, args.host, args.port)
+        print('Serving {} at {} (set MAPSWIPE_HTTP_FIXTURES={})'.format(
+            args.fixtures_dir, server_url(server), server_url(server)))
+
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,15 +16,19 @@
 
 import argparse
 import itertools
-import json
 import os
 import random
 import shutil
 import sys
+import time
 
 import bing_maps
+import instrumentation
+import labelling
 import mapswipe
 from proportional_allocator import ProportionalAllocator
+import shards
+import tile_cache
 
 # Not all datasets are bad_imagery, built, empty.
 # bad_imagery, yes and no are always the correct answers. It's nice to redefine these though, but would need to write down their new names.
@@ -33,7 +37,12 @@ from proportional_allocator import ProportionalAllocator
 # basis. It'd be better to take as many as you can from each project, and accruing the remainder as you go along
 # This would then allow you to create a mix-and-match cross-project final dataset.
 
-def main():
+classes_and_proportions = {'train': 80, 'valid': 10, 'test': 10}
+
+tile_classes = ['built', 'bad_imagery', 'empty']
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('project_ids', metavar='<project_id>', type=int, nargs='+',
                         help='Project IDs to use to generate the dataset.')
@@ -49,8 +58,28 @@ def main():
                              '"valid", etc.')
     parser.add_argument('--inner-test-dir-for-keras', action='store_true',
                         help='Create an extra directory inside the test directory (useful when working with Keras)')
-
-    args = parser.parse_args()
+    parser.add_argument('--format', '-f', choices=['symlinks', 'shards'], default='symlinks',
+                        help='"symlinks" creates a directory per class, full of links into the tile cache. "shards" '
+                             'packs each subset into a few large files, which are much quicker to read when training '
+                             'on network filesystems or spinning disks. Default: symlinks.')
+    parser.add_argument('--shard-size', metavar='<megabytes>', default=shards.DEFAULT_SHARD_SIZE // 2 ** 20, type=int,
+                        help='The maximum size of each shard, when using --format shards. Default: {}.'.format(
+                            shards.DEFAULT_SHARD_SIZE // 2 ** 20))
+    parser.add_argument('--stats-file', metavar='<stats_file>', default=None,
+                        help='Write a JSON report of where the time went (per-stage timings, bytes downloaded, cache '
+                             'hit rate, etc.) to this file at the end of the run.')
+    parser.add_argument('--stats-interval', metavar='<seconds>', default=None, type=float,
+                        help='Print timing statistics every <seconds> seconds, instead of the progress line.')
+    parser.add_argument('--label-rule', '-r', metavar='<rule>', default=labelling.DEFAULT_RULE, type=labelling.parse_rule,
+                        help='How to decide which tiles are built and bad_imagery from their votes, e.g. '
+                             'built_floor=2,min_agreement=0.8. See labelling.py. Default: at least one vote for the '
+                             'class, and none for anything else.')
+    parser.add_argument('--tile-cache-budget', metavar='<size>', default=None, type=tile_cache.parse_size,
+                        help='Once the dataset has been written, evict the least recently used tiles until the tile cache '
+                             'is smaller than <size> (e.g. 50G). Tiles used by this (or any other registered) dataset '
+                             'are never evicted.')
+
+    args = parser.parse_args(argv)
 
     output_dir = args.output_dir
     if os.path.exists(output_dir):
@@ -64,134 +93,198 @@ def main():
     else:
         inner_test_dir = 'test'
 
-    bing_maps_client = bing_maps.BingMapsClient(args.bing_maps_key)
+    stats = instrumentation.Stats()
+    bing_maps_client = bing_maps.BingMapsClient(args.bing_maps_key, stats)
+    tile_index = tile_cache.TileCacheIndex()
 
-    built_floor = 1
-    bad_imagery_floor = 1
+    dataset_writer = DatasetWriter(output_dir, args.format, inner_test_dir, args.shard_size * 2 ** 20)
+    if args.format == 'symlinks':
+        # Shards hold copies of the tiles, but symlinks break if their tiles are evicted.
+        tile_index.register_manifest(output_dir)
 
-    classes_and_proportions = {'train': 80, 'valid': 10, 'test': 10}
+    # Sometimes project boundaries overlap a little, so we have to stop ourselves from selecting the same tile twice. Rather
+    # than remembering every tile we've seen, we use the project index to find the projects we've already used that
+    # overlap this one, and drop the tiles that they contain.
+    project_index = mapswipe.get_project_index()
+    used_project_ids = set()
 
-    tile_classes = ['built', 'bad_imagery', 'empty']
-    for x in itertools.product(['train', 'valid'], tile_classes):
-        os.makedirs(os.path.join(output_dir, *x))
+    total_tile_groups_written = 0
+    last_stats_print = time.perf_counter()
 
-    os.makedirs(os.path.join(output_dir, inner_test_dir))
+    for project_id in args.project_ids:
+        if total_tile_groups_written >= args.max_size:
+            break
 
-    # We have to store all of the tiles in a set to stop us from selecting the same tile twice if it appears in multiple projects
-    # (sometimes the boundaries overlap a little)
-    all_tiles = set()
+        allocator = ProportionalAllocator(classes_and_proportions)
 
-    total_tile_groups_written = 0
+        print('Selecting tiles from project (#{})... '.format(project_id))
+        fresh_project_tiles = select_fresh_tiles(project_id, project_index, used_project_ids, stats)
+        candidates = classify_project_tiles(project_id, fresh_project_tiles, stats, args.label_rule)
+        used_project_ids.add(project_id)
+
+        built_tiles, bad_imagery_tiles, empty_tiles = shuffle_candidates(candidates, args.seed)
 
-    with open(os.path.join(output_dir, 'test', 'solutions.csv'), 'w') as solutions_file:
-        for project_id in args.project_ids:
-            if total_tile_groups_written >= args.max_size:
-                return
-
-            allocator = ProportionalAllocator(classes_and_proportions)
-
-            print('Selecting tiles from project (#{})... '.format(project_id))
-            fresh_project_tiles = set(
-                mapswipe.get_all_tile_quadkeys(project_id)) - all_tiles
-
-            built_tiles = set()
-            bad_imagery_tiles = set()
-            empty_tiles = set()
-
-            with mapswipe.get_project_details_file(project_id, verbose=True) as project_details_file:
-                project_details = json.load(project_details_file)
-
-            annotated_tiles = set()
-            # Normally, we'd just iterate through project details and do our stuff. But project_details is a big blob,
-            # so instead we dismantle it as we go, in the hope that we'll lower
-            # our overall memory usage.
-            while project_details:
-                task = project_details.pop()
-                quadkey = bing_maps.tile_to_quadkey(
-                    (int(task['task_x']), int(task['task_y'])), int(task['task_z']))
-                if quadkey not in fresh_project_tiles:
-                    continue
-
-                annotated_tiles.add(quadkey)
-
-                if task['yes_count'] >= built_floor and task['maybe_count'] == 0 and task['bad_imagery_count'] == 0:
-                    built_tiles.add(quadkey)
-                elif task['yes_count'] == 0 and task['maybe_count'] == 0 and task['bad_imagery_count'] >= bad_imagery_floor:
-                    bad_imagery_tiles.add(quadkey)
-
-            empty_tiles |= (fresh_project_tiles - annotated_tiles)
-
-            all_tiles |= fresh_project_tiles
-
-            # We allow the user to set a random seed for the shuffling, so this means that it's possible to
-            # reproduce a dataset.
-            random.seed(args.seed)
-
-            # The data structures are sets, so we have to sort after converting it to a list to gives us a stable sort order (so that you can generate the same dataset with just a random seed).
-            # Obviously this goes out the window if the ground truth data
-            # changes at MapSwipe's end.
-            built_tiles = list(built_tiles)
-            built_tiles.sort()
-            random.shuffle(built_tiles)
-
-            bad_imagery_tiles = list(bad_imagery_tiles)
-            bad_imagery_tiles.sort()
-            random.shuffle(bad_imagery_tiles)
-
-            empty_tiles = list(empty_tiles)
-            empty_tiles.sort()
-            random.shuffle(empty_tiles)
-
-            while built_tiles and bad_imagery_tiles and empty_tiles and total_tile_groups_written < args.max_size:
-                sample_built = pick_from(built_tiles, bing_maps_client)
-                sample_bad_imagery = pick_from(
-                    bad_imagery_tiles, bing_maps_client)
-                sample_empty = pick_from(empty_tiles, bing_maps_client)
-
-                if sample_built is not None and sample_bad_imagery is not None and sample_empty is not None:
-                    clazz = allocator.allocate()
-
-                    total_tile_groups_written += 1
-                    if clazz == 'test':
-                        output_tile(sample_built, os.path.join(
-                            output_dir, inner_test_dir))
-                        output_tile(sample_bad_imagery,
-                                    os.path.join(output_dir, inner_test_dir))
-                        output_tile(sample_empty, os.path.join(
-                            output_dir, inner_test_dir))
-
-                        solutions_file.write(sample_built + ',built\n')
-                        solutions_file.write(
-                            sample_bad_imagery + ',bad_imagery\n')
-                        solutions_file.write(sample_empty + ',empty\n')
-                        solutions_file.flush()
-                    else:
-                        output_tile(sample_built, os.path.join(
-                            output_dir, clazz, 'built'))
-                        output_tile(sample_bad_imagery, os.path.join(
-                            output_dir, clazz, 'bad_imagery'))
-                        output_tile(sample_empty, os.path.join(
-                            output_dir, clazz, 'empty'))
+        while built_tiles and bad_imagery_tiles and empty_tiles and total_tile_groups_written < args.max_size:
+            sample_built = pick_from(built_tiles, bing_maps_client, stats, tile_index)
+            sample_bad_imagery = pick_from(
+                bad_imagery_tiles, bing_maps_client, stats, tile_index)
+            sample_empty = pick_from(empty_tiles, bing_maps_client, stats, tile_index)
 
+            if sample_built is not None and sample_bad_imagery is not None and sample_empty is not None:
+                clazz = allocator.allocate()
+
+                total_tile_groups_written += 1
+                with stats.timer('output_tile'):
+                    dataset_writer.write_group(clazz, [sample_built, sample_bad_imagery, sample_empty])
+                stats.incr('tile_groups_written')
+
+            if args.stats_interval is None:
                 sys.stdout.write('\r\tTiles picked: {} in each of {}. Total: {}'.format(
                     allocator, tile_classes, allocator.total * 3))
+            elif time.perf_counter() - last_stats_print >= args.stats_interval:
+                print('\tTiles picked: {}. {}'.format(allocator.total * 3, stats.summary_line()))
+                last_stats_print = time.perf_counter()
+
+        sys.stdout.write('\n')
+
+    dataset_writer.close()
+
+    if args.tile_cache_budget is not None:
+        with stats.timer('evict_tiles'):
+            evicted_count, evicted_bytes = tile_index.evict(args.tile_cache_budget)
+        print('Evicted {} tiles ({:.1f}MB) from the tile cache'.format(evicted_count, evicted_bytes / 2 ** 20))
+    tile_index.close()
+
+    if args.stats_file:
+        stats.write_json(args.stats_file)
+        print('Wrote timing statistics to {}'.format(os.path.abspath(args.stats_file)))
+
+
+def select_fresh_tiles(project_id, project_index, used_project_ids, stats):
+    with stats.timer('enumerate_tiles'):
+        fresh_project_tiles = set(
+            mapswipe.get_all_tile_quadkeys(project_id))
+
+    with stats.timer('deduplicate_tiles'):
+        if project_id in used_project_ids:
+            return set()
+
+        for other_project_id in used_project_ids.intersection(project_index.overlapping_projects(project_id)):
+            fresh_project_tiles -= project_index.shared_tiles(project_id, other_project_id)
+
+    return fresh_project_tiles
+
+
+def classify_project_tiles(project_id, fresh_project_tiles, stats, label_rule=labelling.DEFAULT_RULE):
+    # Returns the candidate built, bad_imagery and empty tiles (in that order, i.e. the order of tile_classes).
+    with stats.timer('parse_project_details'):
+        votes = labelling.load_project_votes(project_id)
+
+    with stats.timer('classify'):
+        votes = votes.restrict(fresh_project_tiles)
+        built_tiles, bad_imagery_tiles = labelling.classify(votes, label_rule)
+        empty_tiles = fresh_project_tiles - set(votes.quadkeys.tolist())
+
+    return built_tiles, bad_imagery_tiles, empty_tiles
+
+
+def shuffle_candidates(candidates, seed):
+    # We allow the user to set a random seed for the shuffling, so this means that it's possible to
+    # reproduce a dataset.
+    random.seed(seed)
+
+    # The data structures are sets, so we have to sort after converting it to a list to gives us a stable sort order (so that you can generate the same dataset with just a random seed).
+    # Obviously this goes out the window if the ground truth data
+    # changes at MapSwipe's end.
+    shuffled_candidates = []
+    for tiles in candidates:
+        tiles = list(tiles)
+        tiles.sort()
+        random.shuffle(tiles)
+        shuffled_candidates.append(tiles)
 
-            sys.stdout.write('\n')
+    return shuffled_candidates
 
 
-def pick_from(pool, bing_maps_client):
+class DatasetWriter(object):
+    def __init__(self, output_dir, format, inner_test_dir, shard_size=shards.DEFAULT_SHARD_SIZE):
+        self.output_dir = output_dir
+        self.inner_test_dir = inner_test_dir
+
+        if format == 'shards':
+            self.shard_writers = {clazz: shards.ShardWriter(os.path.join(output_dir, clazz), tile_classes, shard_size)
+                                  for clazz in classes_and_proportions}
+        else:
+            self.shard_writers = None
+
+            for x in itertools.product(['train', 'valid'], tile_classes):
+                os.makedirs(os.path.join(output_dir, *x))
+
+            os.makedirs(os.path.join(output_dir, inner_test_dir))
+
+        self.solutions_file = open(os.path.join(output_dir, 'test', 'solutions.csv'), 'w')
+
+    def write_group(self, clazz, quadkeys):
+        # quadkeys holds one tile for each of tile_classes.
+        for quadkey, tile_class in zip(quadkeys, tile_classes):
+            if self.shard_writers is not None:
+                self.shard_writers[clazz].add(quadkey + '.jpg', tile_class, mapswipe.get_tile_path(quadkey))
+            elif clazz == 'test':
+                output_tile(quadkey, os.path.join(self.output_dir, self.inner_test_dir))
+            else:
+                output_tile(quadkey, os.path.join(self.output_dir, clazz, tile_class))
+
+            if clazz == 'test':
+                self.solutions_file.write('{},{}\n'.format(quadkey, tile_class))
+
+        if clazz == 'test':
+            self.solutions_file.flush()
+
+    def close(self):
+        self.solutions_file.close()
+
+        if self.shard_writers is not None:
+            for shard_writer in self.shard_writers.values():
+                shard_writer.close()
+
+
+def pick_from(pool, bing_maps_client, stats, tile_index=None):
     while pool:
         quadkey = pool.pop()
 
-        tile_path = mapswipe.get_tile_path(quadkey)
+        if probe_tile(quadkey, bing_maps_client, stats, tile_index):
+            return quadkey
 
-        if not os.path.exists(tile_path):
+    return None
+
+
+def probe_tile(quadkey, bing_maps_client, stats, tile_index=None):
+    # Makes sure that the tile is in the tile cache, and returns whether Bing Maps has imagery for it.
+    stats.incr('tiles_probed')
+
+    tile_path = mapswipe.get_tile_path(quadkey)
+
+    with stats.timer('stat_tile_cache'):
+        cached = os.path.exists(tile_path)
+
+    if cached:
+        stats.incr('cache_hits')
+    else:
+        stats.incr('cache_misses')
+        with stats.timer('fetch_tile'):
             bing_maps_client.fetch_tile(quadkey, tile_path)
 
-        if os.path.getsize(tile_path) > 0:
-            return quadkey
+    with stats.timer('stat_tile_cache'):
+        tile_size = os.path.getsize(tile_path)
 
-    return None
+    if tile_index is not None:
+        tile_index.record_access(quadkey, tile_size)
+
+    if tile_size > 0:
+        return True
+
+    stats.incr('no_tile')
+    return False
 
 
 def output_tile(quadkey, output_path):
@@ -238,4 +331,5 @@ def query_yes_no(question, default="yes"):
                              "(or 'y' or 'n').\n")
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# All of our requests to the MapSwipe API go through here. Responses are kept on disk, and are only re-requested once
+# they're older than their TTL, and even then only conditionally (using the ETag / Last-Modified headers), so an
+# unchanged projects.geojson is never downloaded twice. Parsed JSON is also memoised for the life of the process.
+#
+# Setting the MAPSWIPE_HTTP_FIXTURES environment variable to the address of a fixture server (see fixture_server.py)
+# redirects every request to it, so that everything can be run offline.
+
+import hashlib
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+cache_path = os.path.join(os.path.expanduser('~'), '.mapswipe', 'http_cache')
+
+DEFAULT_TTL = 60 * 60
+FIXTURES_ENVIRONMENT_VARIABLE = 'MAPSWIPE_HTTP_FIXTURES'
+
+_json_memo = {}
+
+
+def resolve_url(url):
+    fixtures_url = os.environ.get(FIXTURES_ENVIRONMENT_VARIABLE)
+    if not fixtures_url:
+        return url
+
+    parsed_url = urllib.parse.urlparse(url)
+    return '{}/{}{}'.format(fixtures_url.rstrip('/'), parsed_url.netloc, parsed_url.path)
+
+
+def fetch(url, ttl=DEFAULT_TTL, use_disk_cache=True):
+    if not use_disk_cache:
+        with urllib.request.urlopen(resolve_url(url)) as response:
+            return response.read()
+
+    body_path, metadata_path = _cache_entry_paths(url)
+
+    metadata = None
+    if os.path.isfile(metadata_path) and os.path.isfile(body_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+
+        if time.time() - metadata['fetched_at'] < ttl:
+            return _read(body_path)
+
+    request = urllib.request.Request(resolve_url(url))
+    if metadata is not None:
+        if metadata.get('etag'):
+            request.add_header('If-None-Match', metadata['etag'])
+        if metadata.get('last_modified'):
+            request.add_header('If-Modified-Since', metadata['last_modified'])
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+            headers = response.headers
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or metadata is None:
+            raise
+
+        metadata['fetched_at'] = time.time()
+        write_atomically(metadata_path, json.dumps(metadata).encode())
+        return _read(body_path)
+    except urllib.error.URLError as e:
+        if metadata is None:
+            raise
+
+        sys.stderr.write('Could not fetch {} ({}), using the copy cached at {}.\n'.format(
+            url, e.reason, time.ctime(metadata['fetched_at'])))
+        return _read(body_path)
+
+    if not os.path.isdir(cache_path):
+        os.makedirs(cache_path)
+
+    # Write the body first, so that the metadata never describes a body we don't have.
+    write_atomically(body_path, body)
+    write_atomically(metadata_path, json.dumps({
+        'url': url,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'fetched_at': time.time()
+    }).encode())
+
+    return body
+
+
+def fetch_json(url, ttl=DEFAULT_TTL):
+    if url not in _json_memo:
+        _json_memo[url] = json.loads(fetch(url, ttl).decode())
+
+    return _json_memo[url]
+
+
+def clear_memo():
+    _json_memo.clear()
+
+
+def write_atomically(path, data):
+    # Readers see either the old file or the new one, never a partly written one.
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _cache_entry_paths(url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(cache_path, key + '.body'), os.path.join(cache_path, key + '.json')
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
@@ -0,0 +1,258 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import os
+import time
+
+import numpy as np
+
+QUANTISATION_TYPES = ['float16', 'int8']
+TILE_SIZE = (256, 256)
+
+# What each element of a prediction vector is for. Keras numbers the classes of a dataset in alphabetical order.
+CLASS_NAMES = ['bad_imagery', 'built', 'empty']
+
+
+class KerasPredictor(object):
+    def __init__(self, model_path):
+        from keras.models import load_model
+
+        self.model = load_model(model_path)
+
+    def predict(self, batch):
+        return self.model.predict_on_batch(batch)
+
+
+class TFLitePredictor(object):
+    def __init__(self, model_path, num_threads=None):
+        import tensorflow as tf
+
+        if num_threads is None:
+            self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        else:
+            self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+
+        # Resizing the input tensor forces the interpreter to re-plan its memory, so we only do it when the batch size
+        # changes (i.e. usually just for the first and last batches).
+        if batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch.shape[0]
+
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+
+class FrozenGraphPredictor(object):
+    def __init__(self, model_path, num_threads=None):
+        import tensorflow as tf
+
+        with open(frozen_graph_metadata_path(model_path)) as f:
+            metadata = json.load(f)
+
+        graph_def = tf.compat.v1.GraphDef()
+        with open(model_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        config = tf.compat.v1.ConfigProto()
+        if num_threads is not None:
+            config.intra_op_parallelism_threads = num_threads
+
+        self.session = tf.compat.v1.Session(graph=graph, config=config)
+        self.input_tensor = graph.get_tensor_by_name(metadata['input'])
+        self.output_tensor = graph.get_tensor_by_name(metadata['output'])
+
+    def predict(self, batch):
+        return self.session.run(self.output_tensor, feed_dict={self.input_tensor: batch})
+
+
+# The 8 symmetries of a square tile, ordered so that any prefix is a sensible subset: 2 gives the horizontal flip, 4 gives
+# the flips that train.py augments with, and 8 adds the rotations by 90 degrees.
+DIHEDRAL_TRANSFORMS = [
+    lambda batch: batch,
+    lambda batch: batch[:, :, ::-1],
+    lambda batch: batch[:, ::-1],
+    lambda batch: batch[:, ::-1, ::-1],
+    lambda batch: batch.transpose(0, 2, 1, 3),
+    lambda batch: np.rot90(batch, 1, axes=(1, 2)),
+    lambda batch: np.rot90(batch, 3, axes=(1, 2)),
+    lambda batch: batch[:, ::-1, ::-1].transpose(0, 2, 1, 3),
+]
+
+
+def dihedral_variants(batch, count=len(DIHEDRAL_TRANSFORMS)):
+    # Everything is a view of the already decoded batch until the final concatenate, so this costs one copy per variant.
+    return np.concatenate([transform(batch) for transform in DIHEDRAL_TRANSFORMS[:count]])
+
+
+class TTAPredictor(object):
+    def __init__(self, predictor, variant_count):
+        if not 1 <= variant_count <= len(DIHEDRAL_TRANSFORMS):
+            raise Exception('The number of TTA variants must be between 1 and {}'.format(len(DIHEDRAL_TRANSFORMS)))
+
+        self.predictor = predictor
+        self.variant_count = variant_count
+        # Keep the predictions for the untransformed tiles, so that we can tell what TTA is buying us.
+        self.untransformed_predictions = []
+
+    def predict(self, batch):
+        batch = np.asarray(batch)
+        prediction_vectors = self.predictor.predict(dihedral_variants(batch, self.variant_count))
+        prediction_vectors = np.reshape(prediction_vectors, (self.variant_count, len(batch), -1))
+
+        self.untransformed_predictions.append(prediction_vectors[0])
+        return np.mean(prediction_vectors, axis=0)
+
+
+def frozen_graph_metadata_path(model_path):
+    return model_path + '.json'
+
+
+def load_predictor(model_path, num_threads=None):
+    extension = os.path.splitext(model_path)[1].lower()
+
+    if extension == '.tflite':
+        return TFLitePredictor(model_path, num_threads)
+    elif extension == '.pb':
+        return FrozenGraphPredictor(model_path, num_threads)
+    else:
+        return KerasPredictor(model_path)
+
+
+def export_model(model_path, output_path, quantisation=None):
+    extension = os.path.splitext(output_path)[1].lower()
+
+    if extension == '.tflite':
+        export_tflite(model_path, output_path, quantisation)
+    elif extension == '.pb':
+        if quantisation is not None:
+            raise Exception('Quantisation is only supported when exporting to .tflite')
+        export_frozen_graph(model_path, output_path)
+    else:
+        raise Exception('Unknown export format "{}" (expected .tflite or .pb)'.format(extension))
+
+
+def export_tflite(model_path, output_path, quantisation=None):
+    import tensorflow as tf
+
+    converter = tf.compat.v1.lite.TFLiteConverter.from_keras_model_file(model_path)
+
+    # Both of these are weight-only quantisations: the weights are stored at reduced precision, and activations stay in
+    # float32, so there's no need for a representative dataset to calibrate against.
+    if quantisation == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantisation == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantisation is not None:
+        raise Exception('Unknown quantisation type "{}"'.format(quantisation))
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def export_frozen_graph(model_path, output_path):
+    import tensorflow as tf
+    from keras import backend
+    from keras.models import load_model
+
+    backend.set_learning_phase(0)
+    model = load_model(model_path)
+    session = backend.get_session()
+
+    frozen_graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [output.op.name for output in model.outputs])
+    frozen_graph_def = tf.compat.v1.graph_util.remove_training_nodes(frozen_graph_def)
+
+    with open(output_path, 'wb') as f:
+        f.write(frozen_graph_def.SerializeToString())
+
+    with open(frozen_graph_metadata_path(output_path), 'w') as f:
+        json.dump({'input': model.inputs[0].name, 'output': model.outputs[0].name}, f)
+
+
+class Timings(object):
+    def __init__(self):
+        self.batch_sizes = []
+        self.batch_durations = []
+
+    def record(self, batch_size, duration):
+        self.batch_sizes.append(batch_size)
+        self.batch_durations.append(duration)
+
+    @property
+    def image_count(self):
+        return sum(self.batch_sizes)
+
+    @property
+    def total_duration(self):
+        return sum(self.batch_durations)
+
+    @property
+    def images_per_second(self):
+        if self.total_duration == 0:
+            return 0.0
+        return self.image_count / self.total_duration
+
+    def __str__(self):
+        if not self.batch_durations:
+            return 'No batches run'
+
+        latencies_ms = np.array(self.batch_durations) * 1000.0
+        return '{} images in {:.2f}s ({:.1f} images/s). Batch latency: mean {:.1f}ms, p50 {:.1f}ms, p95 {:.1f}ms'.format(
+            self.image_count, self.total_duration, self.images_per_second, np.mean(latencies_ms),
+            np.percentile(latencies_ms, 50), np.percentile(latencies_ms, 95))
+
+
+def predict_generator(predictor, generator, steps):
+    timings = Timings()
+    prediction_vectors = []
+
+    for _ in range(steps):
+        batch = next(generator)
+        if isinstance(batch, tuple):
+            batch = batch[0]
+
+        start = time.perf_counter()
+        prediction_vectors.append(predictor.predict(batch))
+        timings.record(len(batch), time.perf_counter() - start)
+
+    return np.concatenate(prediction_vectors), timings
+
+
+def load_image(source):
+    from PIL import Image
+
+    # Equivalent to what ImageDataGenerator(rescale=1. / 255) feeds the model when training. source can be a path or a
+    # file-like object.
+    with Image.open(source) as img:
+        img = img.convert('RGB')
+        if img.size != TILE_SIZE:
+            img = img.resize(TILE_SIZE, Image.NEAREST)
+
+        return np.asarray(img, dtype=np.float32) / 255.0
@@ -0,0 +1,87 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import Counter, defaultdict
+import contextlib
+import json
+import time
+
+
+class Stats(object):
+    def __init__(self):
+        self.stage_seconds = defaultdict(float)
+        self.stage_counts = Counter()
+        self.counters = Counter()
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+        self.stage_counts[stage] += 1
+
+    def incr(self, counter, n=1):
+        self.counters[counter] += n
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    @property
+    def cache_hit_rate(self):
+        return ratio(self.counters['cache_hits'], self.counters['cache_hits'] + self.counters['cache_misses'])
+
+    @property
+    def no_tile_rate(self):
+        return ratio(self.counters['no_tile'], self.counters['tiles_probed'])
+
+    def report(self):
+        elapsed = self.elapsed
+        # Copies, as the stats can be added to from other threads while we're reporting on them. Only stages that have
+        # actually been timed are reported.
+        stage_seconds = dict(self.stage_seconds)
+        stage_counts = dict(self.stage_counts)
+        counters = dict(self.counters)
+        return {
+            'elapsed_seconds': elapsed,
+            'stages': {stage: {'seconds': seconds,
+                               'count': stage_counts.get(stage, 0),
+                               'fraction_of_elapsed': ratio(seconds, elapsed)}
+                       for stage, seconds in sorted(stage_seconds.items())},
+            'counters': dict(sorted(counters.items())),
+            'cache_hit_rate': self.cache_hit_rate,
+            'no_tile_rate': self.no_tile_rate,
+            'download_bytes_per_second': ratio(counters.get('bytes_downloaded', 0), stage_seconds.get('download', 0.0))
+        }
+
+    def summary_line(self):
+        return '{:.0f}s elapsed; {} tiles probed ({:.1%} cached, {:.1%} no tile); {:.1f}MB downloaded; {:.0f}s throttled'.format(
+            self.elapsed, self.counters['tiles_probed'], self.cache_hit_rate, self.no_tile_rate,
+            self.counters['bytes_downloaded'] / 2 ** 20, self.stage_seconds.get('throttle_sleep', 0.0))
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def ratio(numerator, denominator):
+    if denominator == 0:
+        return 0.0
+    return numerator / denominator
@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Decides which annotated tiles are built and bad_imagery, from their MapSwipe votes. The votes for a project are kept as
+# columns (one array per vote type), and a set of label rules is evaluated over them all at once, so that trying out
+# lots of different rules is cheap:
+#
+#   ./labelling.py 6807 6794 --label-rule default --label-rule built_floor=2 --label-rule min_agreement=0.75,maybe=ignore
+#
+# A label rule is written as comma separated key=value pairs, where the keys are:
+#   built_floor        The minimum number of yes votes for a tile to be built. Default: 1
+#   bad_imagery_floor  The minimum number of bad imagery votes for a tile to be bad_imagery. Default: 1
+#   min_agreement      The minimum proportion of a tile's votes that must be for its class. Default: 1.0, i.e. unanimous
+#   maybe              How maybe votes are counted: dissent (against either class), ignore, or yes. Default: dissent
+#   max_maybe          The most maybe votes that a tile can have (however they're counted). Default: no limit
+#
+# The default rule is the one that generate_dataset.py has always used: at least one vote for the class, and no votes
+# for anything else.
+
+import argparse
+from collections import namedtuple
+import json
+import os
+
+import numpy as np
+
+import bing_maps
+import mapswipe
+
+LabelRule = namedtuple('LabelRule', ['built_floor', 'bad_imagery_floor', 'min_agreement', 'maybe', 'max_maybe'])
+
+DEFAULT_RULE = LabelRule(built_floor=1, bad_imagery_floor=1, min_agreement=1.0, maybe='dissent', max_maybe=None)
+
+MAYBE_MODES = ['dissent', 'ignore', 'yes']
+
+# Tolerance for min_agreement comparisons, so that e.g. 7 out of 10 votes meets min_agreement=0.7.
+AGREEMENT_EPSILON = 1e-9
+
+# Rules are evaluated over this many tasks at a time, to bound the size of the (rules x tasks) intermediate arrays.
+CHUNK_SIZE = 2 ** 20
+
+
+def parse_rule(spec):
+    if spec.strip() == 'default':
+        return DEFAULT_RULE
+
+    types = {'built_floor': int, 'bad_imagery_floor': int, 'min_agreement': float, 'maybe': str, 'max_maybe': int}
+
+    values = {}
+    for item in spec.split(','):
+        key, _, value = item.partition('=')
+        key = key.strip()
+        if key not in types:
+            raise argparse.ArgumentTypeError('Unknown label rule key "{}" in "{}". Expected one of: {}'.format(
+                key, spec, ', '.join(LabelRule._fields)))
+        try:
+            values[key] = types[key](value.strip())
+        except ValueError:
+            raise argparse.ArgumentTypeError('Invalid value "{}" for {} in "{}".'.format(value.strip(), key, spec))
+
+    rule = DEFAULT_RULE._replace(**values)
+    if rule.maybe not in MAYBE_MODES:
+        raise argparse.ArgumentTypeError('maybe must be one of {}, not "{}".'.format(', '.join(MAYBE_MODES),
+                                                                                     rule.maybe))
+    if not 0.0 <= rule.min_agreement <= 1.0:
+        raise argparse.ArgumentTypeError('min_agreement must be between 0 and 1, not {}.'.format(rule.min_agreement))
+
+    return rule
+
+
+def format_rule(rule):
+    if rule == DEFAULT_RULE:
+        return 'default'
+
+    return ','.join('{}={}'.format(key, value) for key, value in rule._asdict().items()
+                    if value != getattr(DEFAULT_RULE, key))
+
+
+def read_rules_file(path):
+    # One rule per line. Blank lines and lines starting with # are ignored.
+    with open(path) as f:
+        return [parse_rule(line) for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+class VoteTable(object):
+    def __init__(self, quadkeys, yes_counts, maybe_counts, bad_imagery_counts):
+        self.quadkeys = quadkeys
+        self.yes_counts = yes_counts
+        self.maybe_counts = maybe_counts
+        self.bad_imagery_counts = bad_imagery_counts
+
+    def __len__(self):
+        return len(self.quadkeys)
+
+    @classmethod
+    def from_project_details(cls, project_details):
+        quadkeys = [bing_maps.tile_to_quadkey((int(task['task_x']), int(task['task_y'])), int(task['task_z']))
+                    for task in project_details]
+
+        return cls(np.array(quadkeys, dtype=str),
+                   np.array([task['yes_count'] for task in project_details], dtype=np.int32),
+                   np.array([task['maybe_count'] for task in project_details], dtype=np.int32),
+                   np.array([task['bad_imagery_count'] for task in project_details], dtype=np.int32))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['quadkeys'], arrays['yes_counts'], arrays['maybe_counts'], arrays['bad_imagery_counts'])
+
+    def save(self, path):
+        # Written via a temporary file, so that an interrupted run doesn't leave a truncated table behind.
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, quadkeys=self.quadkeys, yes_counts=self.yes_counts, maybe_counts=self.maybe_counts,
+                 bad_imagery_counts=self.bad_imagery_counts)
+        os.replace(temp_path, path)
+
+    def restrict(self, quadkeys):
+        mask = np.fromiter((quadkey in quadkeys for quadkey in self.quadkeys.tolist()), dtype=bool,
+                           count=len(self.quadkeys))
+        return self[mask]
+
+    def __getitem__(self, selection):
+        return VoteTable(self.quadkeys[selection], self.yes_counts[selection], self.maybe_counts[selection],
+                         self.bad_imagery_counts[selection])
+
+
+def load_project_votes(project_id, verbose=True):
+    # Parsing project_details.json is slow, so the votes are cached alongside it as columns.
+    project_details_path = os.path.join(mapswipe.working_dir_path, str(project_id), 'project_details.json')
+    votes_path = os.path.join(mapswipe.working_dir_path, str(project_id), 'votes.npz')
+
+    if os.path.isfile(votes_path) and os.path.isfile(project_details_path) and \
+            os.path.getmtime(votes_path) >= os.path.getmtime(project_details_path):
+        return VoteTable.load(votes_path)
+
+    with mapswipe.get_project_details_file(project_id, verbose=verbose) as project_details_file:
+        votes = VoteTable.from_project_details(json.load(project_details_file))
+
+    votes.save(votes_path)
+    return votes
+
+
+def evaluate(votes, rules):
+    # Returns two boolean arrays of shape (len(rules), len(votes)): whether each rule labels each task as built, and
+    # whether it labels it as bad_imagery. A task is never labelled as both (built wins).
+    def column(values):
+        return np.array(values, dtype=np.float64)[:, np.newaxis]
+
+    built_floor = column([rule.built_floor for rule in rules])
+    bad_imagery_floor = column([rule.bad_imagery_floor for rule in rules])
+    min_agreement = column([rule.min_agreement for rule in rules]) - AGREEMENT_EPSILON
+    max_maybe = column([np.inf if rule.max_maybe is None else rule.max_maybe for rule in rules])
+    maybe_as_yes = column([rule.maybe == 'yes' for rule in rules]).astype(bool)
+    maybe_as_dissent = column([rule.maybe == 'dissent' for rule in rules]).astype(bool)
+
+    maybe_counts = votes.maybe_counts[np.newaxis, :]
+    yes_counts = votes.yes_counts[np.newaxis, :] + np.where(maybe_as_yes, maybe_counts, 0)
+    bad_imagery_counts = votes.bad_imagery_counts[np.newaxis, :]
+    total_counts = yes_counts + bad_imagery_counts + np.where(maybe_as_dissent, maybe_counts, 0)
+
+    allowed = maybe_counts <= max_maybe
+    built = allowed & (yes_counts >= built_floor) & (yes_counts >= min_agreement * total_counts)
+    bad_imagery = allowed & ~built & (bad_imagery_counts >= bad_imagery_floor) & \
+        (bad_imagery_counts >= min_agreement * total_counts)
+
+    return built, bad_imagery
+
+
+def class_sizes(votes, rules):
+    # The number of built and bad_imagery tiles that each rule would give, as two arrays of length len(rules).
+    built_sizes = np.zeros(len(rules), dtype=np.int64)
+    bad_imagery_sizes = np.zeros(len(rules), dtype=np.int64)
+
+    for start in range(0, len(votes), CHUNK_SIZE):
+        built, bad_imagery = evaluate(votes[start:start + CHUNK_SIZE], rules)
+        built_sizes += built.sum(axis=1)
+        bad_imagery_sizes += bad_imagery.sum(axis=1)
+
+    return built_sizes, bad_imagery_sizes
+
+
+def classify(votes, rule):
+    built, bad_imagery = evaluate(votes, [rule])
+    return set(votes.quadkeys[built[0]].tolist()), set(votes.quadkeys[bad_imagery[0]].tolist())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the class sizes given by different label rules.')
+    parser.add_argument('project_ids', metavar='<project_id>', type=int, nargs='+',
+                        help='The project IDs to evaluate the rules over.')
+    parser.add_argument('--label-rule', '-r', metavar='<rule>', action='append', type=parse_rule, default=[],
+                        help='A label rule, e.g. built_floor=2,min_agreement=0.8 (can be given more than once).')
+    parser.add_argument('--label-rules', '-f', metavar='<rules_file>', default=None,
+                        help='A file with one label rule per line.')
+    parser.add_argument('--empty', '-e', action='store_true',
+                        help='Also count the empty tiles (the unannotated tiles within each project), which means '
+                             'enumerating every tile in the projects.')
+
+    args = parser.parse_args(argv)
+
+    rules = args.label_rule
+    if args.label_rules:
+        try:
+            rules = rules + read_rules_file(args.label_rules)
+        except argparse.ArgumentTypeError as e:
+            parser.error('{}: {}'.format(args.label_rules, e))
+    if not rules:
+        rules = [DEFAULT_RULE]
+
+    built_sizes = np.zeros(len(rules), dtype=np.int64)
+    bad_imagery_sizes = np.zeros(len(rules), dtype=np.int64)
+    tile_group_counts = np.zeros(len(rules), dtype=np.int64)
+    task_count = 0
+    empty_size = 0
+
+    for project_id in args.project_ids:
+        votes = load_project_votes(project_id)
+        task_count += len(votes)
+
+        project_built_sizes, project_bad_imagery_sizes = class_sizes(votes, rules)
+        built_sizes += project_built_sizes
+        bad_imagery_sizes += project_bad_imagery_sizes
+
+        if args.empty:
+            project_tiles = set(mapswipe.get_all_tile_quadkeys(project_id))
+            project_empty_size = len(project_tiles - set(votes.quadkeys.tolist()))
+            empty_size += project_empty_size
+            tile_group_counts += np.minimum(np.minimum(project_built_sizes, project_bad_imagery_sizes),
+                                            project_empty_size)
+        else:
+            tile_group_counts += np.minimum(project_built_sizes, project_bad_imagery_sizes)
+
+    print('{} rules over {} tasks from {} projects{}'.format(
+        len(rules), task_count, len(args.project_ids), ', {} empty tiles'.format(empty_size) if args.empty else ''))
+    print('{:>10} {:>12} {:>12}  {}'.format('built', 'bad_imagery', 'tile_groups', 'rule'))
+    for rule, built_size, bad_imagery_size, tile_group_count in zip(rules, built_sizes, bad_imagery_sizes,
+                                                                    tile_group_counts):
+        print('{:>10} {:>12} {:>12}  {}'.format(built_size, bad_imagery_size, tile_group_count, format_rule(rule)))
+    print('(tile_groups is an upper bound: some tiles have no imagery, and overlapping projects share tiles.)')
+
+
+if __name__ == '__main__':
+    main()
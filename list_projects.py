@@ -15,15 +15,27 @@
 #   limitations under the License.
 
 import argparse
-from collections import Counter
-import json
-import urllib.request
+import sys
+
+import catalogue
 
 def pretty_print_map(int_value_map):
     for key, value in sorted(int_value_map.items(), key=lambda x: int(x[1]), reverse=True):
         print('\t{}: {}'.format(key, value))
 
-def main():
+def parse_lat_long_box(value):
+    try:
+        box = tuple(float(x) for x in value.split(','))
+    except ValueError:
+        box = ()
+
+    if len(box) != 4:
+        raise argparse.ArgumentTypeError('Expected <south,west,north,east>, e.g. 13.9,100.1,22.5,107.7, not "{}"'.format(
+            value))
+
+    return box
+
+def main(argv=None):
 
     # The most useful functionality for this is probably:
     #   One summary report of all the various lookFors
@@ -33,58 +45,48 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('command', metavar='<types>',
                         help='Commands include lookFors, or a category from the merged lookFors')
-
-    args = parser.parse_args()
-
-    mappings = {
-        'buildings only' : 'buildings',
-        'roads only': 'roads',
-        'houses & roads': 'houses and roads',
-        'houses/roads': 'houses and roads'
-    }
-
-    states = {0: 'Not started', 1: 'On hold', 2: 'Complete', 3: 'Hidden'}
-
-    # Uses the mapswipe API as defined in: https://docs.google.com/document/d/1RwN4BNhgMT5Nj9EWYRBWxIZck5iaawg9i_5FdAAderw/
-    with urllib.request.urlopen("http://api.mapswipe.org/projects.json") as url:
-        projects = json.loads(url.read().decode())
+    parser.add_argument('--offline', action='store_true',
+                        help='Use the local project catalogue as it is, without checking the MapSwipe API for changes')
+    parser.add_argument('--min-progress', metavar='<percent>', default=100, type=int,
+                        help='Only list projects that are at least this complete. Default: 100')
+    parser.add_argument('--state', choices=sorted(catalogue.STATES.values()), default=None,
+                        help='Only list projects in this state')
+    parser.add_argument('--within', metavar='<south,west,north,east>', default=None,
+                        type=parse_lat_long_box,
+                        help='Only list projects whose bounding boxes overlap this lat/long box')
+    parser.add_argument('--ids-only', action='store_true',
+                        help='Just print the project ids, e.g. to pass to generate_dataset.py')
+
+    args = parser.parse_args(argv)
+
+    projects = catalogue.open_catalogue(offline=args.offline, boundaries=args.within is not None)
 
     if args.command == 'lookFors':
-        project_type_counts = Counter()
-        for project_id, project_details in projects.items():
-            if 'lookFor' in project_details:
-                project_type_counts[project_details['lookFor']] += 1
-        
         print('Raw data:')
-        pretty_print_map(project_type_counts)
+        pretty_print_map(projects.look_for_counts())
 
         print('\nMerging a few types:')
-        merged_project_type_counts = Counter()
-        for key, value in project_type_counts.items():
-            key = key.lower()
-            if key in mappings:
-                look_for = mappings[key]
-            else:
-                look_for = key
-            
-            merged_project_type_counts[look_for] += value
-
-        pretty_print_map(merged_project_type_counts)
+        pretty_print_map(projects.look_for_counts(normalised=True))
     else:
-        target = args.command
+        state = None
+        if args.state is not None:
+            state = next(k for k, v in catalogue.STATES.items() if v == args.state)
+
+        matches = projects.find_projects(look_for=args.command, state=state, min_progress=args.min_progress,
+                                         within=args.within)
+
+        if args.ids_only:
+            print(' '.join(str(project.project_id) for project in matches))
+        else:
+            for project in matches:
+                print('{0}; {1} [{2}] ({3}%) [{4}]'.format(project.project_id, project.name, (project.look_for or '').title(),
+                                                           project.progress, catalogue.STATES[project.state]))
 
-        for project_id, project_details in sorted(projects.items(), key=lambda x: int(x[0])):
-            if 'name' not in project_details:
-                continue
-            if project_details['progress'] != 100:
-                continue
+        if not matches:
+            sys.stderr.write('No matching projects.\n')
 
-            lookFor = project_details['lookFor'].lower()
-            if lookFor in mappings:
-                lookFor = mappings[lookFor]
+    projects.close()
 
-            if target == 'all' or lookFor == target:
-                print('{0}; {1} [{2}] ({3}%) [{4}]'.format(project_id, project_details['name'], project_details['lookFor'].title(),
-                                                   project_details['progress'], states[project_details['state']]))
 
-main()
+if __name__ == '__main__':
+    main()
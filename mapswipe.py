@@ -12,19 +12,26 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import hashlib
 import json
 import os
 import pickle
-import shapely.geometry
-import shutil
 import sys
-import urllib.request
 
 import bing_maps
+import http_cache
+from project_index import ProjectIndex
 
 working_dir_path = os.path.join(os.path.expanduser('~'), '.mapswipe')
 tile_cache_path = os.path.join(working_dir_path, 'tiles')
 
+# Uses the mapswipe API as defined in: https://docs.google.com/document/d/1RwN4BNhgMT5Nj9EWYRBWxIZck5iaawg9i_5FdAAderw/
+PROJECTS_URL = 'http://api.mapswipe.org/projects.json'
+PROJECT_DETAILS_URL = 'http://api.mapswipe.org/projects/{0}.json'
+PROJECTS_GEOJSON_URL = 'http://mapswipe.geog.uni-heidelberg.de/data/projects.geojson'
+
+_project_index = None
+
 
 def get_tile_path(quadkey, make_directories=True):
     # This hopefully stops us from having directories with loads of files.
@@ -49,17 +56,18 @@ def get_project_details_file(project_id, verbose=True):
         if verbose:
             sys.stdout.write('Downloading project details (#' + str(project_id) + ')... ')
 
-        download_url = 'http://api.mapswipe.org/projects/{0}.json'.format(str(project_id))
-        (download_filename, headers) = urllib.request.urlretrieve(download_url)
+        # project_details.json is its own cache, so there's no point keeping a second copy in the HTTP cache.
+        project_details = http_cache.fetch(PROJECT_DETAILS_URL.format(str(project_id)), use_disk_cache=False)
 
-        if os.path.getsize(download_filename) == 0:
+        if len(project_details) == 0:
             raise Exception('Empty response.')
 
         parent_path = os.path.dirname(project_details_path)
         if not os.path.isdir(parent_path):
             os.makedirs(parent_path)
 
-        shutil.move(download_filename, project_details_path)
+        # Written atomically, as a truncated file would otherwise be taken for a cached copy on the next run.
+        http_cache.write_atomically(project_details_path, project_details)
 
         if verbose:
             sys.stdout.write(' Done\n')
@@ -67,23 +75,14 @@ def get_project_details_file(project_id, verbose=True):
     return open(project_details_path)
 
 
-def get_all_buildings_only_projects():
-    target_categories = ['buildings only', 'buildings']
+def get_all_buildings_only_projects(offline=False):
+    import catalogue
 
-    with urllib.request.urlopen("http://api.mapswipe.org/projects.json") as url:
-        raw_projects = json.loads(url.read().decode())
+    projects = catalogue.open_catalogue(offline=offline)
+    all_projects = {str(project.project_id): project.name
+                    for project in projects.find_projects(look_for='buildings', min_progress=100)}
+    projects.close()
 
-    all_projects = {}
-    for project_id, project_details in sorted(raw_projects.items(), key=lambda x: int(x[0])):
-        if 'name' not in project_details:
-            continue
-        if project_details['progress'] != 100:
-            continue
-
-        lookFor = project_details['lookFor'].lower()
-        if lookFor in target_categories:
-            all_projects[project_id] = project_details['name']
-    
     return all_projects
 
 
@@ -102,20 +101,7 @@ def get_all_tile_quadkeys(project_id, verbose=True):
     if not os.path.isdir(parent_path):
         os.makedirs(parent_path)
 
-    with urllib.request.urlopen('http://mapswipe.geog.uni-heidelberg.de/data/projects.geojson') as url:
-        data = json.loads(url.read().decode())
-
-    features = [x for x in data['features'] if x['properties']['project_id'] == int(project_id)]
-
-    if len(features) == 0:
-        raise Exception('Could not find feature.')
-    elif len(features) > 1:
-        raise Exception('Found multiple projects with the target id.')
-
-    feature = features[0]
-
-    bounding_poly = shapely.geometry.Polygon((bing_maps.latlong_to_pixel((point[1], point[0]), 18)
-                                              for point in feature['geometry']['coordinates'][0]))
+    bounding_poly = get_project_index().polygon(project_id)
 
     ret_val = [bing_maps.tile_to_quadkey(tile, 18) for tile in bing_maps.tiles_in_pixel_box(bounding_poly.bounds)
                if bounding_poly.contains(bing_maps.tile_to_pixel_box(tile))]
@@ -128,3 +114,41 @@ def get_all_tile_quadkeys(project_id, verbose=True):
         sys.stdout.flush()
 
     return ret_val
+
+
+def get_project_index(verbose=True):
+    global _project_index
+
+    # The index is only checked against projects.geojson once per run.
+    if _project_index is not None:
+        return _project_index
+
+    project_index_path = os.path.join(working_dir_path, 'project_index.pickled')
+
+    geojson = http_cache.fetch(PROJECTS_GEOJSON_URL)
+    digest = hashlib.sha1(geojson).hexdigest()
+
+    if os.path.isfile(project_index_path):
+        with open(project_index_path, 'rb') as f:
+            project_index = pickle.load(f)
+
+        if project_index.digest == digest:
+            _project_index = project_index
+            return _project_index
+
+    if verbose:
+        sys.stdout.write('Indexing project boundaries... ')
+        sys.stdout.flush()
+
+    _project_index = ProjectIndex.from_geojson(json.loads(geojson.decode()), digest)
+
+    if not os.path.isdir(working_dir_path):
+        os.makedirs(working_dir_path)
+
+    http_cache.write_atomically(project_index_path, pickle.dumps(_project_index))
+
+    if verbose:
+        sys.stdout.write('Done\n')
+        sys.stdout.flush()
+
+    return _project_index
@@ -1,26 +1,24 @@
+import argparse
 import os
 import pickle
 
 import numpy as np
 
-import sklearn.metrics
-
 from itertools import islice, zip_longest
 import numpy as np
-from IPython.display import HTML, Markdown
 from bing_maps import *
-import pandas as pd
 import mapswipe
 from pathlib import Path
 from collections import defaultdict, namedtuple
 import bing_maps
+import inference
 
 TileVotes = namedtuple('TileVotes', ['yes_count', 'maybe_count', 'bad_imagery_count'])
 TileVotes.__iadd__ = lambda x,y: TileVotes(x.yes_count + y.yes_count,
                      x.maybe_count + y.maybe_count,
                      x.bad_imagery_count + y.bad_imagery_count)
 
-class_names = ['bad_imagery', 'built', 'empty']
+class_names = inference.CLASS_NAMES
 class_number_to_name = {k: v for k, v in enumerate(class_names)}
 class_name_to_number = {v: k for k, v in class_number_to_name.items()}
 
@@ -37,12 +35,15 @@ def predictions_file_to_map(predictions_path):
     with open(predictions_path, 'rb') as f:
         (paths, prediction_vectors) = zip(*pickle.load(f))
 
-        quadkeys = []
-        for path in paths:
-            filename = os.path.basename(path)
-            quadkeys.append(filename[0:filename.index('.')])
-        
-        return dict(zip(quadkeys, prediction_vectors))
+        return predictions_to_map(paths, prediction_vectors)
+
+def predictions_to_map(paths, prediction_vectors):
+    quadkeys = []
+    for path in paths:
+        filename = os.path.basename(path)
+        quadkeys.append(filename[0:filename.index('.')])
+
+    return dict(zip(quadkeys, prediction_vectors))
 
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
@@ -50,34 +51,121 @@ def grouper(iterable, n, fillvalue=None):
     args = [iter(iterable)] * n
     return zip_longest(*args, fillvalue=fillvalue)
 
-def tableau(quadkeys, solution = None):
-    retVal = "<table>"
-    for row in grouper(quadkeys, 3):
-        html_row = "<tr>"
-        for quadkey in row:
-            html_row += "<td align=\"center\" style=\"text-align: center\">"
-            if quadkey is not None:
-                html_row += cell_renderer(quadkey, solution)
-            html_row += "</td>"
-        html_row += "</tr>"
-        retVal += html_row
-    retVal += "</table>"
-    display(HTML(retVal))
-    
-def cell_renderer(quadkey, solution):
+def tableau(quadkeys, solution = None, page = None, page_size = 30):
+    from IPython.display import HTML, display
+
+    # One sprite sheet per page, rather than one image per tile. Every page is shown, unless page is given. Later pages
+    # are built in the background, so tableau(quadkeys, solution, page=1) is usually instant.
+    review = TileReview(quadkeys, solution, page_size=page_size, columns=3, thumb_size=256)
+
+    if page is None:
+        for page_number in range(review.page_count):
+            display(HTML(review.page_html(page_number)))
+        return
+
+    html = review.page_html(page)
+    if page + 1 < review.page_count:
+        html += "<p>Only showing page {} of {}. Use tableau(..., page={}) for the next page (page counts from 0), or leave out page to show them all.</p>".format(
+            page + 1, review.page_count, page + 1)
+    display(HTML(html))
+
+def cell_renderer(quadkey, solution, image_html = None):
     retVal = ""
     retVal = "Quadkey: <a href=\"{}\" target=\"_blank\">{}</a><br>".format(quadkey_to_url(quadkey), quadkey)
     if solution is not None:
         retVal += "Officially: {}<br>".format(solution.ground_truth[quadkey])
         retVal += "Predicted class: " + solution.predicted_class(quadkey) + "<br>"
-    
-    retVal += "<img align=\"center\" src=\"mapswipe_working_dir/{}\"/><br>".format(os.path.relpath(mapswipe.get_tile_path(quadkey),
-                                                                         os.path.join(str(Path.home()),'.mapswipe')))
+
+    if image_html is None:
+        image_html = "<img align=\"center\" src=\"{}\"/>".format(notebook_path(mapswipe.get_tile_path(quadkey)))
+    retVal += image_html + "<br>"
     if solution is not None:
         retVal += "PV:" + str(solution.prediction_vectors[quadkey])
     
     return retVal
 
+def notebook_path(path):
+    # Notebooks get at ~/.mapswipe through a mapswipe_working_dir symlink next to them.
+    return "mapswipe_working_dir/{}".format(os.path.relpath(path, os.path.join(str(Path.home()), '.mapswipe')))
+
+class TileReview:
+    """Pages through lots of tiles (e.g. from Solution.classified_as) without freezing the notebook.
+
+    Each page is a single downscaled sprite sheet, built on a thread pool and cached in ~/.mapswipe/sprites, and the
+    next few pages are built in the background while you look at the current one. In a notebook:
+
+        review = TileReview(solution.classified_as(predicted_class='built', solution_class='empty'), solution)
+        review            # shows the first page
+        review.next()     # or review.show(7)
+    """
+
+    def __init__(self, quadkeys, solution = None, page_size = 60, columns = 6, thumb_size = 128, prefetch = 2):
+        # Also takes classified_as()'s (quadkey, prediction vector) pairs.
+        self.quadkeys = [x[0] if isinstance(x, tuple) else x for x in quadkeys]
+        self.solution = solution
+        self.page_size = page_size
+        self.columns = columns
+        self.thumb_size = thumb_size
+        self.prefetch = prefetch
+        self.current_page = 0
+
+    @property
+    def page_count(self):
+        return max(1, (len(self.quadkeys) + self.page_size - 1) // self.page_size)
+
+    def page_quadkeys(self, page):
+        return self.quadkeys[page * self.page_size:(page + 1) * self.page_size]
+
+    def page_html(self, page):
+        import sprite_sheets
+
+        if not 0 <= page < self.page_count:
+            raise Exception('Page {} is out of range (there are {} pages).'.format(page, self.page_count))
+
+        sheet_future = sprite_sheets.request_sheet(self.page_quadkeys(page), self.thumb_size, self.columns)
+        for next_page in range(page + 1, min(page + 1 + self.prefetch, self.page_count)):
+            sprite_sheets.request_sheet(self.page_quadkeys(next_page), self.thumb_size, self.columns)
+
+        sheet_url = notebook_path(sheet_future.result())
+
+        retVal = "<table>"
+        for row_number, row in enumerate(grouper(self.page_quadkeys(page), self.columns)):
+            retVal += "<tr>"
+            for column_number, quadkey in enumerate(row):
+                retVal += "<td align=\"center\" style=\"text-align: center\">"
+                if quadkey is not None:
+                    x, y = sprite_sheets.sprite_offset(row_number * self.columns + column_number, self.thumb_size,
+                                                       self.columns)
+                    image_html = ("<div style=\"width: {0}px; height: {0}px; margin: auto; background: url('{1}') "
+                                  "-{2}px -{3}px\"></div>").format(self.thumb_size, sheet_url, x, y)
+                    retVal += cell_renderer(quadkey, self.solution, image_html)
+                retVal += "</td>"
+            retVal += "</tr>"
+        retVal += "</table>"
+
+        first_tile = page * self.page_size
+        retVal += "<p>Page {} of {} (tiles {}-{} of {})</p>".format(
+            page + 1, self.page_count, min(first_tile + 1, len(self.quadkeys)),
+            min(first_tile + self.page_size, len(self.quadkeys)), len(self.quadkeys))
+
+        return retVal
+
+    def show(self, page = None):
+        from IPython.display import HTML, display
+
+        if page is not None:
+            self.current_page = page
+        display(HTML(self.page_html(self.current_page)))
+
+    def next(self):
+        self.show(min(self.current_page + 1, self.page_count - 1))
+
+    def previous(self):
+        self.show(max(self.current_page - 1, 0))
+
+    def _repr_html_(self):
+        return self.page_html(self.current_page)
+
 def get_all_tile_votes_for_projects(project_ids):
     retval = defaultdict(lambda: TileVotes(0, 0, 0))
 
@@ -95,6 +183,8 @@ def get_all_tile_votes_for_projects(project_ids):
 
 class Solution:
     def __init__(self, ground_truth, prediction_vectors):
+        import sklearn.metrics
+
         self.ground_truth = ground_truth
         self.prediction_vectors = prediction_vectors
 
@@ -127,3 +217,41 @@ class Solution:
 
     def predicted_class(self, quadkey):
         return class_number_to_name[np.argmax(self.prediction_vectors[quadkey])]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--solutions', '-s', metavar='<solutions_csv>', required=True,
+                        help='Ground truth (e.g. test/solutions.csv)')
+    parser.add_argument('--predictions', '-p', metavar='<predictions_file>', required=True,
+                        help='Predictions written by test.py')
+
+    args = parser.parse_args(argv)
+
+    solution = Solution(ground_truth_solutions_file_to_map(args.solutions),
+                        predictions_file_to_map(args.predictions))
+
+    print('Accuracy: {:.4f} ({} tiles)'.format(solution.accuracy, solution.tile_count))
+    for name, accuracy in zip(class_names, solution.category_accuracies):
+        print('\t{}: {:.4f}'.format(name, accuracy))
+
+    print('Confusion matrix (rows: ground truth, columns: predicted):')
+    print('\t' + '\t'.join(class_names))
+    for name, row in zip(class_names, solution.confusion_matrix):
+        print('{}\t'.format(name) + '\t'.join(str(x) for x in row))
+
+# pandas and IPython are only needed in notebooks, and take a while to import, so they're imported on first use. They're
+# listed in __all__ so that "from mapswipe_analysis import *" still provides them.
+def __getattr__(name):
+    if name == 'pd':
+        import pandas
+        return pandas
+    elif name in ('HTML', 'Markdown'):
+        import IPython.display
+        return getattr(IPython.display, name)
+
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+__all__ = [name for name in globals() if not name.startswith('_')] + ['pd', 'HTML', 'Markdown']
+
+if __name__ == '__main__':
+    main()
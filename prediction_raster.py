@@ -0,0 +1,313 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Predictions laid out on the zoom level 18 tile grid, so that they can be mapped without joining them back to their
+# tiles. A raster is a directory:
+#
+#   metadata.json    Georeferencing (the tile at the top left, lat/long bounds, and an EPSG:3857 geotransform for each
+#                    level), the class names and the project ids.
+#   level-0.npy      A (height, width, classes) float32 array with a row per tile row and a column per tile column.
+#                    Tiles without a prediction are NaN.
+#   level-1.npy ...  Overviews: each level is half the size of the one before, averaging each 2x2 block (ignoring NaNs).
+#
+# The arrays are memory mapped (numpy.load(..., mmap_mode='r') works on them too), so a country-sized raster can be
+# written, rendered and queried without ever being loaded into RAM.
+
+import argparse
+import json
+import os
+import pickle
+import warnings
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import bing_maps
+import inference
+
+LEVEL_OF_DETAIL = 18
+
+# Overviews are built until the smallest one fits within this many pixels in each direction.
+OVERVIEW_MIN_SIZE = 256
+
+# Arrays are filled and downsampled this many rows at a time, to bound memory use.
+STRIP_ROWS = 1024
+
+# Web Mercator (EPSG:3857) constants, for the geotransforms.
+EARTH_CIRCUMFERENCE = 40075016.685578488
+HALF_EARTH_CIRCUMFERENCE = EARTH_CIRCUMFERENCE / 2
+
+METADATA_FILENAME = 'metadata.json'
+
+
+def level_filename(level):
+    return 'level-{}.npy'.format(level)
+
+
+def tile_bounds_of_pixel_box(bounds):
+    # Converts level 18 pixel bounds (min_x, min_y, max_x, max_y) into the tile bounds that cover them, as
+    # (min_x, min_y, max_x, max_y) with the maxima exclusive.
+    top_left_tile = bing_maps.pixel_to_tile((bounds[0], bounds[1]))
+    bottom_right_tile = bing_maps.pixel_to_tile((bounds[2], bounds[3]))
+
+    return top_left_tile[0], top_left_tile[1], bottom_right_tile[0] + 1, bottom_right_tile[1] + 1
+
+
+def tile_bounds_of_quadkeys(quadkeys):
+    tiles = [bing_maps.quadkey_to_tile(quadkey) for quadkey in quadkeys]
+    if not tiles:
+        raise Exception('No predictions to make a raster from.')
+
+    return (min(tile[0] for tile in tiles), min(tile[1] for tile in tiles),
+            max(tile[0] for tile in tiles) + 1, max(tile[1] for tile in tiles) + 1)
+
+
+def georeference(tile_bounds, level):
+    # The position of a level's array on the map. Each pixel at overview <level> covers 2 ** level tiles in each
+    # direction (and the last row and column can hang over the edge of tile_bounds).
+    scale = 2 ** level
+    tile_metres = EARTH_CIRCUMFERENCE / bing_maps.calc_map_size(LEVEL_OF_DETAIL) * 256
+
+    top_left = bing_maps.tile_to_pixel(tile_bounds[:2])
+    bottom_right = bing_maps.tile_to_pixel(tile_bounds[2:])
+    north, west = bing_maps.pixel_to_latlong(top_left, LEVEL_OF_DETAIL)
+    south, east = bing_maps.pixel_to_latlong(bottom_right, LEVEL_OF_DETAIL)
+
+    return {
+        'latlong_bounds': [south, west, north, east],
+        'geotransform': [tile_bounds[0] * tile_metres - HALF_EARTH_CIRCUMFERENCE, tile_metres * scale, 0.0,
+                         HALF_EARTH_CIRCUMFERENCE - tile_bounds[1] * tile_metres, 0.0, -tile_metres * scale],
+        'crs': 'EPSG:3857'
+    }
+
+
+class PredictionRaster(object):
+    def __init__(self, path, metadata, mode='r'):
+        self.path = path
+        self.metadata = metadata
+        self.mode = mode
+        self.tile_bounds = tuple(metadata['tile_bounds'])
+        self.class_names = metadata['class_names']
+        self._levels = {}
+
+    @classmethod
+    def create(cls, path, tile_bounds, class_names, project_ids=None):
+        if os.path.exists(path):
+            raise Exception('{} already exists.'.format(path))
+        os.makedirs(path)
+
+        metadata = {
+            'level_of_detail': LEVEL_OF_DETAIL,
+            'tile_bounds': list(tile_bounds),
+            'class_names': list(class_names),
+            'project_ids': list(project_ids or []),
+            'levels': []
+        }
+        raster = cls(path, metadata, mode='w')
+
+        shape = (tile_bounds[3] - tile_bounds[1], tile_bounds[2] - tile_bounds[0], len(class_names))
+        raster._create_level(0, shape)
+
+        return raster
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, METADATA_FILENAME)) as f:
+            return cls(path, json.load(f))
+
+    @property
+    def level_count(self):
+        return len(self.metadata['levels'])
+
+    def level(self, level=0):
+        # The (memory mapped) array for a level.
+        if level not in self._levels:
+            if level >= self.level_count:
+                raise Exception('{} has no level {} (it has {} levels).'.format(self.path, level, self.level_count))
+            self._levels[level] = np.load(os.path.join(self.path, level_filename(level)),
+                                          mmap_mode='r' if self.mode == 'r' else 'r+')
+
+        return self._levels[level]
+
+    def _create_level(self, level, shape):
+        array = open_memmap(os.path.join(self.path, level_filename(level)), mode='w+', dtype=np.float32, shape=shape)
+        for start in range(0, shape[0], STRIP_ROWS):
+            array[start:start + STRIP_ROWS] = np.nan
+
+        self._levels[level] = array
+        self.metadata['levels'].append(dict({'level': level, 'shape': list(shape)},
+                                            **georeference(self.tile_bounds, level)))
+        return array
+
+    def tile_index(self, quadkey):
+        # The (row, column) of a tile in level 0, or None if it's outside the raster.
+        tile_x, tile_y, level_of_detail = bing_maps.quadkey_to_tile(quadkey)
+        if level_of_detail != LEVEL_OF_DETAIL:
+            raise Exception('Expected a level {} quadkey, not {}.'.format(LEVEL_OF_DETAIL, quadkey))
+
+        row, column = tile_y - self.tile_bounds[1], tile_x - self.tile_bounds[0]
+        if not (0 <= row < self.level(0).shape[0] and 0 <= column < self.level(0).shape[1]):
+            return None
+
+        return row, column
+
+    def write(self, quadkeys, prediction_vectors):
+        # Returns the number of predictions that fell outside the raster (and so weren't written).
+        indices = [self.tile_index(quadkey) for quadkey in quadkeys]
+        inside = np.array([index is not None for index in indices], dtype=bool)
+        if not inside.any():
+            return len(indices)
+
+        rows, columns = zip(*[index for index in indices if index is not None])
+        self.level(0)[np.array(rows), np.array(columns)] = np.asarray(prediction_vectors, dtype=np.float32)[inside]
+
+        return int((~inside).sum())
+
+    def build_overviews(self):
+        level = 0
+        while max(self.level(level).shape[:2]) > OVERVIEW_MIN_SIZE:
+            source = self.level(level)
+            height, width, class_count = source.shape
+            destination = self._create_level(level + 1, ((height + 1) // 2, (width + 1) // 2, class_count))
+
+            for start in range(0, height, STRIP_ROWS * 2):
+                strip = np.array(source[start:start + STRIP_ROWS * 2])
+
+                # Pad odd edges with NaN, so that every output pixel averages a full 2x2 block.
+                padded = np.full((strip.shape[0] + strip.shape[0] % 2, width + width % 2, class_count), np.nan,
+                                 dtype=np.float32)
+                padded[:strip.shape[0], :width] = strip
+                blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, class_count)
+
+                with warnings.catch_warnings():
+                    # Blocks with no predictions at all are expected, and stay NaN.
+                    warnings.simplefilter('ignore', category=RuntimeWarning)
+                    destination[start // 2:start // 2 + blocks.shape[0]] = np.nanmean(blocks, axis=(1, 3))
+
+            level += 1
+
+    def close(self):
+        for array in self._levels.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+        self._levels = {}
+
+        if self.mode != 'r':
+            with open(os.path.join(self.path, METADATA_FILENAME), 'w') as f:
+                json.dump(self.metadata, f, indent=2)
+
+    def prediction_for_tile(self, quadkey):
+        index = self.tile_index(quadkey)
+        if index is None:
+            return None
+
+        prediction_vector = self.level(0)[index]
+        return None if np.isnan(prediction_vector).all() else np.array(prediction_vector)
+
+    def pixel_at_latlong(self, latlong, level=0):
+        # The (row, column) of the pixel at a lat/long in a level, or None if it's outside the raster.
+        row, column = self._unclipped_pixel(latlong, level)
+
+        shape = self.level(level).shape
+        if not (0 <= row < shape[0] and 0 <= column < shape[1]):
+            return None
+
+        return row, column
+
+    def window(self, south_west, north_east, level=0):
+        # The part of a level within a lat/long box. This is a view of the memory mapped array, so nothing is read
+        # until it's used.
+        top, left = self._unclipped_pixel((north_east[0], south_west[1]), level)
+        bottom, right = self._unclipped_pixel((south_west[0], north_east[1]), level)
+
+        return self.level(level)[max(top, 0):max(bottom + 1, 0), max(left, 0):max(right + 1, 0)]
+
+    def _unclipped_pixel(self, latlong, level):
+        tile_x, tile_y = bing_maps.pixel_to_tile(bing_maps.latlong_to_pixel(latlong, LEVEL_OF_DETAIL))
+        return (tile_y - self.tile_bounds[1]) // 2 ** level, (tile_x - self.tile_bounds[0]) // 2 ** level
+
+
+def write_raster(path, quadkeys, prediction_vectors, class_names, project_index=None, project_ids=None):
+    # The raster covers the given projects' boundaries if there are any, otherwise just the predictions.
+    if project_ids:
+        project_bounds = [project_index.bounds[project_id] for project_id in project_ids]
+        tile_bounds = tile_bounds_of_pixel_box((min(b[0] for b in project_bounds), min(b[1] for b in project_bounds),
+                                                max(b[2] for b in project_bounds), max(b[3] for b in project_bounds)))
+    else:
+        tile_bounds = tile_bounds_of_quadkeys(quadkeys)
+
+    raster = PredictionRaster.create(path, tile_bounds, class_names, project_ids)
+    outside_count = raster.write(quadkeys, prediction_vectors)
+    raster.build_overviews()
+    raster.close()
+
+    return raster, outside_count
+
+
+def quadkeys_of_paths(paths):
+    return [os.path.basename(path).split('.')[0] for path in paths]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser('build', help='Make a raster from the results of test.py')
+    build_parser.add_argument('--predictions', '-p', metavar='<predictions_file>', required=True,
+                              help='The output of test.py')
+    build_parser.add_argument('--output', '-o', metavar='<raster_dir>', required=True)
+    build_parser.add_argument('--project-id', metavar='<project_id>', type=int, action='append', default=[],
+                              help='Make the raster cover this project (can be given more than once). Default: just '
+                                   'cover the predictions')
+    build_parser.add_argument('--class-names', default=','.join(inference.CLASS_NAMES),
+                              help='The class of each element of the prediction vectors. Default: '
+                                   '{}'.format(','.join(inference.CLASS_NAMES)))
+
+    query_parser = subparsers.add_parser('query', help='Look up the prediction at a lat/long')
+    query_parser.add_argument('raster', metavar='<raster_dir>')
+    query_parser.add_argument('latitude', type=float)
+    query_parser.add_argument('longitude', type=float)
+    query_parser.add_argument('--level', '-l', default=0, type=int, help='The overview level to query. Default: 0')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        with open(args.predictions, 'rb') as f:
+            paths, prediction_vectors = zip(*pickle.load(f))
+
+        project_index = None
+        if args.project_id:
+            import mapswipe
+            project_index = mapswipe.get_project_index()
+
+        raster, outside_count = write_raster(args.output, quadkeys_of_paths(paths), np.array(prediction_vectors),
+                                             args.class_names.split(','), project_index, args.project_id)
+        print('Wrote a {}x{} raster with {} levels to {} ({} predictions were outside it)'.format(
+            raster.metadata['levels'][0]['shape'][1], raster.metadata['levels'][0]['shape'][0], raster.level_count,
+            os.path.abspath(args.output), outside_count))
+    else:
+        raster = PredictionRaster.open(args.raster)
+        index = raster.pixel_at_latlong((args.latitude, args.longitude), args.level)
+        if index is None:
+            print('Outside the raster')
+        else:
+            print(', '.join('{}: {:.4f}'.format(name, p)
+                            for name, p in zip(raster.class_names, raster.level(args.level)[index])))
+
+
+if __name__ == '__main__':
+    main()
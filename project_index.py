@@ -0,0 +1,144 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A spatial index over the boundaries of every MapSwipe project. Project boundaries are stored in level 18 pixel
+# coordinates, and bucketed by the level CELL_LEVEL tiles that their bounding boxes cover, so the candidates for any level
+# 18 tile are just the projects in the bucket named by the first CELL_LEVEL characters of its quadkey.
+
+from collections import defaultdict
+import shapely.geometry
+import shapely.prepared
+
+import bing_maps
+
+LEVEL_OF_DETAIL = 18
+CELL_LEVEL = 10
+
+
+class ProjectIndex(object):
+    def __init__(self, boundaries, digest):
+        # boundaries maps project ids to a list of the exterior rings of every feature with that id (there should only
+        # ever be one).
+        self.boundaries = boundaries
+        self.digest = digest
+        self.bounds = {}
+        self.cells = defaultdict(list)
+
+        for project_id, rings in boundaries.items():
+            xs = [x for ring in rings for (x, _) in ring]
+            ys = [y for ring in rings for (_, y) in ring]
+            self.bounds[project_id] = (min(xs), min(ys), max(xs), max(ys))
+
+            for cell in cells_in_pixel_box(self.bounds[project_id]):
+                self.cells[cell].append(project_id)
+
+        self.cells = dict(self.cells)
+        self._polygons = {}
+
+    @classmethod
+    def from_geojson(cls, data, digest=None):
+        boundaries = defaultdict(list)
+        for feature in data['features']:
+            ring = [bing_maps.latlong_to_pixel((point[1], point[0]), LEVEL_OF_DETAIL)
+                    for point in feature['geometry']['coordinates'][0]]
+            boundaries[int(feature['properties']['project_id'])].append(ring)
+
+        return cls(dict(boundaries), digest)
+
+    def __getstate__(self):
+        # Shapely geometries are rebuilt on demand rather than pickled.
+        return {'boundaries': self.boundaries, 'digest': self.digest, 'bounds': self.bounds, 'cells': self.cells}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._polygons = {}
+
+    def __contains__(self, project_id):
+        return int(project_id) in self.boundaries
+
+    def polygon(self, project_id):
+        project_id = int(project_id)
+
+        if project_id not in self._polygons:
+            rings = self.boundaries.get(project_id, [])
+            if len(rings) == 0:
+                raise Exception('Could not find feature.')
+            elif len(rings) > 1:
+                raise Exception('Found multiple projects with the target id.')
+
+            polygon = shapely.geometry.Polygon(rings[0])
+            self._polygons[project_id] = (polygon, shapely.prepared.prep(polygon))
+
+        return self._polygons[project_id][0]
+
+    def project_contains_tile(self, project_id, quadkey):
+        project_id = int(project_id)
+        tile = bing_maps.quadkey_to_tile(quadkey)
+        tile_box = bing_maps.tile_to_pixel(tile) + bing_maps.tile_to_pixel((tile[0] + 1, tile[1] + 1))
+
+        if not box_contains(self.bounds[project_id], tile_box):
+            return False
+
+        self.polygon(project_id)
+        return self._polygons[project_id][1].contains(bing_maps.tile_to_pixel_box(tile))
+
+    def shared_tiles(self, project_id, other_project_id):
+        # The tiles of other_project_id that lie within project_id's boundary, found by only enumerating the tiles in the
+        # bounding box of the overlap between the two.
+        overlap = self.polygon(project_id).intersection(self.polygon(other_project_id))
+        if overlap.is_empty:
+            return set()
+
+        other_prepared = self._polygons[int(other_project_id)][1]
+        return {bing_maps.tile_to_quadkey(tile, LEVEL_OF_DETAIL) for tile in bing_maps.tiles_in_pixel_box(overlap.bounds)
+                if other_prepared.contains(bing_maps.tile_to_pixel_box(tile))}
+
+    def projects_containing_tile(self, quadkey):
+        if len(quadkey) != LEVEL_OF_DETAIL:
+            raise Exception('Expected a level {} quadkey'.format(LEVEL_OF_DETAIL))
+
+        return [project_id for project_id in self.cells.get(quadkey[:CELL_LEVEL], [])
+                if len(self.boundaries[project_id]) == 1 and self.project_contains_tile(project_id, quadkey)]
+
+    def overlapping_projects(self, project_id):
+        project_id = int(project_id)
+        bounds = self.bounds[project_id]
+
+        candidates = set()
+        for cell in cells_in_pixel_box(bounds):
+            candidates.update(self.cells.get(cell, []))
+        candidates.discard(project_id)
+
+        polygon = self.polygon(project_id)
+        return sorted(other for other in candidates
+                      if boxes_intersect(bounds, self.bounds[other]) and len(self.boundaries[other]) == 1 and
+                      polygon.intersects(self.polygon(other)))
+
+
+def cells_in_pixel_box(bounds):
+    shift = LEVEL_OF_DETAIL - CELL_LEVEL
+    top_left_tile = bing_maps.pixel_to_tile((bounds[0], bounds[1]))
+    bottom_right_tile = bing_maps.pixel_to_tile((bounds[2], bounds[3]))
+
+    for cell_x in range(top_left_tile[0] >> shift, (bottom_right_tile[0] >> shift) + 1):
+        for cell_y in range(top_left_tile[1] >> shift, (bottom_right_tile[1] >> shift) + 1):
+            yield bing_maps.tile_to_quadkey((cell_x, cell_y), CELL_LEVEL)
+
+
+def box_contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+def boxes_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# A long-running prediction service. The model is loaded once, and concurrent requests are coalesced into micro-batches
+# so that scoring a single tile doesn't pay TensorFlow's start-up cost.
+#
+# API:
+#   POST /predict  {"quadkeys": ["...", ...]}  Score tiles from the local tile cache.
+#   POST /predict  <JPEG bytes>                 Score an image (Content-Type: image/jpeg or image/png).
+#   GET  /predict?quadkey=...                   Score a single tile from the local tile cache.
+#   GET  /stats                                 Batching statistics.
+
+import argparse
+from concurrent.futures import Future
+import functools
+import http.server
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+import inference
+import mapswipe
+import tile_cache
+
+class TileError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher(object):
+    def __init__(self, load_predictor, max_batch_size, max_latency):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.request_count = 0
+        self.batch_count = 0
+
+        # The predictor is created on the batching thread (and only ever used from there), as Keras models aren't
+        # safe to use from a different thread to the one they were loaded on.
+        self._ready = threading.Event()
+        self._load_error = None
+        self._thread = threading.Thread(target=self._run, args=(load_predictor,), daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+        if self._load_error is not None:
+            raise self._load_error
+
+    def predict(self, images):
+        futures = []
+        for image in images:
+            future = Future()
+            self.queue.put((image, future))
+            futures.append(future)
+
+        return [future.result() for future in futures]
+
+    def _run(self, load_predictor):
+        try:
+            predictor = load_predictor()
+        except Exception as e:
+            self._load_error = e
+            return
+        finally:
+            self._ready.set()
+
+        while True:
+            items = [self.queue.get()]
+
+            # Wait for more requests to turn up, but never hold the first one for longer than max_latency.
+            deadline = time.monotonic() + self.max_latency
+            while len(items) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.request_count += len(items)
+            self.batch_count += 1
+
+            try:
+                prediction_vectors = predictor.predict(np.stack([image for image, _ in items]))
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), prediction_vector in zip(items, prediction_vectors):
+                future.set_result(prediction_vector)
+
+
+def load_cached_tile(quadkey):
+    if not isinstance(quadkey, str) or not quadkey or quadkey.strip('0123') != '':
+        raise TileError(400, 'Malformed quadkey {}'.format(json.dumps(quadkey)))
+
+    tile_path = mapswipe.get_tile_path(quadkey, make_directories=False)
+
+    if not os.path.exists(tile_path):
+        raise TileError(404, 'Tile {} is not in the tile cache'.format(quadkey))
+
+    tile_size = os.path.getsize(tile_path)
+    tile_cache.touch(quadkey, tile_size)
+    if tile_size == 0:
+        raise TileError(422, 'Bing Maps has no imagery for tile {}'.format(quadkey))
+
+    return inference.load_image(tile_path)
+
+
+def prediction_to_json(prediction_vector):
+    return {name: float(p) for name, p in zip(inference.CLASS_NAMES, prediction_vector)}
+
+
+class PredictionRequestHandler(http.server.BaseHTTPRequestHandler):
+    batcher = None
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+
+        if url.path == '/stats':
+            batch_count = self.batcher.batch_count
+            self._send_json(200, {
+                'requests': self.batcher.request_count,
+                'batches': batch_count,
+                'mean_batch_size': self.batcher.request_count / batch_count if batch_count else 0.0,
+                'queued': self.batcher.queue.qsize()
+            })
+        elif url.path == '/predict':
+            quadkeys = urllib.parse.parse_qs(url.query).get('quadkey', [])
+            self._predict_quadkeys(quadkeys)
+        else:
+            self._send_json(404, {'error': 'Unknown path {}'.format(url.path)})
+
+    def do_POST(self):
+        if urllib.parse.urlparse(self.path).path != '/predict':
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '')
+
+        if content_type.startswith('application/json'):
+            try:
+                quadkeys = json.loads(body.decode())['quadkeys']
+            except (ValueError, KeyError, TypeError):
+                quadkeys = None
+            if not isinstance(quadkeys, list):
+                self._send_json(400, {'error': 'Expected {"quadkeys": [...]}'})
+                return
+            self._predict_quadkeys(quadkeys)
+        elif content_type.startswith('image/'):
+            try:
+                image = inference.load_image(io.BytesIO(body))
+            except Exception as e:
+                self._send_json(400, {'error': 'Could not decode image: {}'.format(e)})
+                return
+            try:
+                prediction_vector = self.batcher.predict([image])[0]
+            except Exception as e:
+                self._send_json(500, {'error': 'Prediction failed: {}'.format(e)})
+                return
+            self._send_json(200, {'prediction': prediction_to_json(prediction_vector)})
+        else:
+            self._send_json(415, {'error': 'Unsupported Content-Type "{}"'.format(content_type)})
+
+    def _predict_quadkeys(self, quadkeys):
+        if not quadkeys:
+            self._send_json(400, {'error': 'No quadkeys given'})
+            return
+
+        try:
+            images = [load_cached_tile(quadkey) for quadkey in quadkeys]
+        except TileError as e:
+            self._send_json(e.status, {'error': str(e)})
+            return
+
+        try:
+            prediction_vectors = self.batcher.predict(images)
+        except Exception as e:
+            self._send_json(500, {'error': 'Prediction failed: {}'.format(e)})
+            return
+
+        self._send_json(200, {'predictions': {quadkey: prediction_to_json(prediction_vector)
+                                              for quadkey, prediction_vector in zip(quadkeys, prediction_vectors)}})
+
+    def _send_json(self, status, body):
+        encoded = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def address_string(self):
+        # Unix socket clients don't have an address.
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'unix'
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', '-m', required=True, metavar='<model_file>',
+                        help='Model to serve (a Keras HDF5 checkpoint, or a model exported by export_model.py)')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', '-p', default=8642, type=int, help='Port to listen on. Default: 8642')
+    parser.add_argument('--socket', '-u', metavar='<socket_path>', default=None,
+                        help='Listen on a Unix socket instead of a TCP port')
+    parser.add_argument('--max-batch-size', '-b', default=64, type=int,
+                        help='The maximum number of tiles to score in one batch. Default: 64')
+    parser.add_argument('--max-latency-ms', '-l', default=10.0, type=float,
+                        help='The longest a request will wait for other requests to batch with. Default: 10')
+    parser.add_argument('--threads', '-t', default=None, type=int,
+                        help='The number of CPU threads to use for inference (exported models only)')
+
+    args = parser.parse_args(argv)
+
+    print('Loading {}...'.format(args.model))
+    PredictionRequestHandler.batcher = MicroBatcher(
+        functools.partial(inference.load_predictor, args.model, args.threads),
+        args.max_batch_size, args.max_latency_ms / 1000.0)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, PredictionRequestHandler)
+        print('Listening on {}'.format(args.socket))
+    else:
+        server = http.server.ThreadingHTTPServer((args.host, args.port), PredictionRequestHandler)
+        print('Listening on http://{}:{}/'.format(args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Datasets stored as a few large files, rather than a directory of symlinks per class, so that they can be read
+# sequentially. Each split directory (train, valid, test) contains:
+#   shard-00000.bin, shard-00001.bin, ...   The JPEG bytes of each tile, concatenated.
+#   index.json                              The classes, and for each shard a list of [filename, class, offset, length].
+
+import io
+import json
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+
+import inference
+
+INDEX_FILENAME = 'index.json'
+DEFAULT_SHARD_SIZE = 256 * 2 ** 20
+
+
+def is_sharded(split_dir):
+    return os.path.isfile(os.path.join(split_dir, INDEX_FILENAME))
+
+
+class ShardWriter(object):
+    def __init__(self, split_dir, classes, shard_size=DEFAULT_SHARD_SIZE):
+        self.split_dir = split_dir
+        self.classes = sorted(classes)
+        self.shard_size = shard_size
+        self.shards = []
+        self._shard_file = None
+
+        if not os.path.isdir(split_dir):
+            os.makedirs(split_dir)
+
+    def add(self, filename, clazz, tile_path):
+        if clazz not in self.classes:
+            raise Exception('Unknown class "{}"'.format(clazz))
+
+        with open(tile_path, 'rb') as f:
+            data = f.read()
+
+        if self._shard_file is None or self._shard_file.tell() + len(data) > self.shard_size:
+            self._next_shard()
+
+        offset = self._shard_file.tell()
+        self._shard_file.write(data)
+        self.shards[-1]['samples'].append([filename, clazz, offset, len(data)])
+
+    def close(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+
+        # The index is written last, so a split only looks sharded once it's complete.
+        with open(os.path.join(self.split_dir, INDEX_FILENAME), 'w') as f:
+            json.dump({'classes': self.classes, 'shards': self.shards}, f)
+
+    def _next_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+
+        shard_filename = 'shard-{:05d}.bin'.format(len(self.shards))
+        self._shard_file = open(os.path.join(self.split_dir, shard_filename), 'wb')
+        self.shards.append({'path': shard_filename, 'samples': []})
+
+
+class ShardReader(object):
+    # A drop-in replacement for the iterators returned by Keras' ImageDataGenerator.flow_from_directory(): it yields
+    # (images, one-hot labels) batches forever, with a partial batch at the end of each epoch.
+    #
+    # When shuffling, the order of the shards is shuffled each epoch, and so is the order of the samples within each
+    # shard (once it's in memory), but each shard is still read from start to finish in one go. The next shard is read
+    # on a background thread while the current one is being decoded.
+
+    def __init__(self, split_dir, batch_size, shuffle=True, seed=None, horizontal_flip=False, vertical_flip=False):
+        with open(os.path.join(split_dir, INDEX_FILENAME)) as f:
+            index = json.load(f)
+
+        self.split_dir = split_dir
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.horizontal_flip = horizontal_flip
+        self.vertical_flip = vertical_flip
+        self.random = random.Random(seed)
+
+        self.classes = index['classes']
+        self.class_indices = {clazz: i for i, clazz in enumerate(self.classes)}
+        self.shards = index['shards']
+        self.filenames = [sample[0] for shard in self.shards for sample in shard['samples']]
+        self.samples = len(self.filenames)
+
+        self._batches = self._generate_batches()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._batches)
+
+    def __len__(self):
+        return (self.samples + self.batch_size - 1) // self.batch_size
+
+    def _generate_batches(self):
+        while True:
+            shards = list(self.shards)
+            if self.shuffle:
+                self.random.shuffle(shards)
+
+            images = []
+            labels = []
+            for shard, data in self._read_shards(shards):
+                samples = list(shard['samples'])
+                if self.shuffle:
+                    self.random.shuffle(samples)
+
+                for _, clazz, offset, length in samples:
+                    images.append(self._load_image(data[offset:offset + length]))
+                    labels.append(self.class_indices[clazz])
+
+                    if len(images) == self.batch_size:
+                        yield self._make_batch(images, labels)
+                        images = []
+                        labels = []
+
+            if images:
+                yield self._make_batch(images, labels)
+
+    def _read_shards(self, shards):
+        shard_data = queue.Queue(maxsize=1)
+
+        def read():
+            try:
+                for shard in shards:
+                    with open(os.path.join(self.split_dir, shard['path']), 'rb') as f:
+                        shard_data.put((shard, memoryview(f.read())))
+            except Exception as e:
+                shard_data.put((None, e))
+
+        threading.Thread(target=read, daemon=True).start()
+
+        for _ in shards:
+            shard, data = shard_data.get()
+            if shard is None:
+                raise data
+            yield shard, data
+
+    def _load_image(self, data):
+        image = inference.load_image(io.BytesIO(data))
+
+        if self.horizontal_flip and self.random.random() < 0.5:
+            image = image[:, ::-1]
+        if self.vertical_flip and self.random.random() < 0.5:
+            image = image[::-1]
+
+        return image
+
+    def _make_batch(self, images, labels):
+        one_hot_labels = np.zeros((len(labels), len(self.classes)), dtype=np.float32)
+        one_hot_labels[np.arange(len(labels)), labels] = 1.0
+
+        return np.stack(images), one_hot_labels
@@ -0,0 +1,120 @@
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Sprite sheets: many tiles, shrunk and pasted into one JPEG, so that a page of tiles in a notebook is one image request
+# rather than one per tile. Sheets are built on a thread pool, and cached in ~/.mapswipe/sprites by a hash of what's in
+# them (the quadkeys, the tile sizes on disk, and the layout), so reviewing the same tiles again costs nothing.
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import os
+import threading
+
+from PIL import Image
+
+import mapswipe
+import tile_cache
+
+sprites_path = os.path.join(mapswipe.working_dir_path, 'sprites')
+
+# Tiles that aren't in the tile cache, or that Bing Maps has no imagery for.
+MISSING_TILE_COLOUR = (128, 128, 128)
+
+JPEG_QUALITY = 85
+
+_executor = None
+_in_flight = {}
+_lock = threading.RLock()
+
+
+def sheet_key(quadkeys, thumb_size, columns):
+    hash = hashlib.sha1('{}:{}'.format(thumb_size, columns).encode())
+    for quadkey in quadkeys:
+        tile_path = mapswipe.get_tile_path(quadkey, make_directories=False)
+        tile_size = os.path.getsize(tile_path) if os.path.exists(tile_path) else -1
+
+        # Tiles never change once they're in the tile cache, but they can turn up after the sheet was built.
+        hash.update('{}:{};'.format(quadkey, tile_size).encode())
+
+    return hash.hexdigest()
+
+
+def sheet_path(key):
+    return os.path.join(sprites_path, key + '.jpg')
+
+
+def build_sheet(quadkeys, thumb_size, columns, path):
+    rows = max(1, (len(quadkeys) + columns - 1) // columns)
+    sheet = Image.new('RGB', (columns * thumb_size, rows * thumb_size), MISSING_TILE_COLOUR)
+
+    for i, quadkey in enumerate(quadkeys):
+        tile_path = mapswipe.get_tile_path(quadkey, make_directories=False)
+        if not os.path.exists(tile_path):
+            continue
+
+        tile_size = os.path.getsize(tile_path)
+        tile_cache.touch(quadkey, tile_size)
+        if tile_size == 0:
+            continue
+
+        with Image.open(tile_path) as tile:
+            # For JPEGs, draft() decodes at a reduced scale, which is much quicker than decoding and then resizing.
+            tile.draft('RGB', (thumb_size, thumb_size))
+            thumbnail = tile.convert('RGB')
+            if thumbnail.size != (thumb_size, thumb_size):
+                thumbnail = thumbnail.resize((thumb_size, thumb_size), Image.BILINEAR)
+
+        sheet.paste(thumbnail, sprite_offset(i, thumb_size, columns))
+
+    if not os.path.isdir(sprites_path):
+        os.makedirs(sprites_path, exist_ok=True)
+
+    temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    sheet.save(temp_path, 'JPEG', quality=JPEG_QUALITY)
+    os.replace(temp_path, path)
+
+    return path
+
+
+def request_sheet(quadkeys, thumb_size, columns):
+    # Returns a Future for the path of the sprite sheet. Cached sheets are returned straight away, and a sheet that's
+    # already being built isn't built twice.
+    global _executor
+
+    path = sheet_path(sheet_key(quadkeys, thumb_size, columns))
+    if os.path.exists(path):
+        future = Future()
+        future.set_result(path)
+        return future
+
+    with _lock:
+        future = _in_flight.get(path)
+        if future is None:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+            future = _executor.submit(build_sheet, list(quadkeys), thumb_size, columns, path)
+            _in_flight[path] = future
+            future.add_done_callback(lambda _: _forget(path))
+
+        return future
+
+
+def _forget(path):
+    with _lock:
+        _in_flight.pop(path, None)
+
+
+def sprite_offset(index, thumb_size, columns):
+    return (index % columns) * thumb_size, (index // columns) * thumb_size
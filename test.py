@@ -20,40 +20,170 @@ import numpy as np
 import os
 import pickle
 
-from keras.models import load_model
-from keras.preprocessing import image
+import inference
+import prediction_raster
+import shards
 
-def main():
+# With --tta, this many batches are also timed through the model without TTA, to compare throughput against. Another
+# batch goes through first, untimed, as the model's first batch of a new size pays for resizing its inputs.
+UNTRANSFORMED_TIMING_BATCHES = 4
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--dataset-dir', '-i', metavar='<dataset_dir>', required=True,
                     help='Input directory')
     parser.add_argument('--model', '-m', required=True, metavar='<model_file>',
-                        help='Model to use')
+                        help='Model to use. Either a Keras HDF5 checkpoint, or a model exported by export_model.py '
+                             '(.tflite or .pb)')
     parser.add_argument('--batch-size', '-b', required=False,
                         default=64, type=int, help='The test batch size')
     parser.add_argument('--output', '-o', metavar='<output_file>', required=True,
                         help="Output file path")
+    parser.add_argument('--threads', '-t', required=False, default=None, type=int,
+                        help='The number of CPU threads to use for inference (exported models only)')
+    parser.add_argument('--solutions', '-s', metavar='<solutions_csv>', required=False, default=None,
+                        help='Ground truth (e.g. test/solutions.csv). If specified, the accuracy of the model is reported')
+    parser.add_argument('--reference-model', '-r', metavar='<model_file>', required=False, default=None,
+                        help='Another model to run over the same tiles, to report the accuracy delta against (e.g. the '
+                             'checkpoint that --model was exported from). Requires --solutions.')
+    parser.add_argument('--tta', required=False, default=1, type=int, metavar='<variant_count>',
+                        help='Test-time augmentation: average the predictions over this many flipped/rotated variants '
+                             'of each tile (1-8). Each batch is run through the model as one batch of '
+                             '<batch_size> * <variant_count> images. Default: 1 (no augmentation)')
+    parser.add_argument('--raster-output', metavar='<raster_dir>', required=False, default=None,
+                        help='Also write the predictions as a memory mapped raster on the zoom level 18 tile grid, with '
+                             'overviews (see prediction_raster.py)')
+    parser.add_argument('--project-id', metavar='<project_id>', required=False, type=int, action='append', default=[],
+                        help='Make the raster cover this project\'s boundary (can be given more than once). Default: '
+                             'just cover the predictions')
+
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    if args.reference_model and not args.solutions:
+        parser.error('--reference-model requires --solutions')
 
-    model = load_model(args.model)
+    if args.project_id and not args.raster_output:
+        parser.error('--project-id requires --raster-output')
 
-    test_datagen = image.ImageDataGenerator(rescale=1. / 255)
+    if not 1 <= args.tta <= len(inference.DIHEDRAL_TRANSFORMS):
+        parser.error('--tta must be between 1 and {}'.format(len(inference.DIHEDRAL_TRANSFORMS)))
 
-    test_generator = test_datagen.flow_from_directory(
-        args.dataset_dir,
-        target_size=(256, 256),
-        batch_size=args.batch_size,
-        class_mode='categorical',
-        follow_links=True,
-        shuffle=False)
-    prediction_vectors = model.predict_generator(test_generator, math.ceil(len(test_generator.filenames) / args.batch_size))
+    prediction_vectors, filenames, timings, untransformed_vectors, untransformed_timings = run_predictions(args.model,
+                                                                                                          args)
+    print('{}: {}'.format(args.model, timings))
 
     with open(args.output, "wb") as output_file:
-        abs_filenames = (os.path.abspath(os.path.join(args.dataset_dir, x)) for x in test_generator.filenames)
+        abs_filenames = [os.path.abspath(os.path.join(args.dataset_dir, x)) for x in filenames]
         pickle.dump(list(zip(abs_filenames, prediction_vectors)), output_file)
 
     print('Wrote {} results to {}'.format(len(prediction_vectors), os.path.abspath(args.output)))
 
-main()
+    if args.raster_output:
+        write_raster(args.raster_output, abs_filenames, prediction_vectors, args.project_id)
+
+    if args.solutions:
+        solution = evaluate(args.model, abs_filenames, prediction_vectors, args.solutions)
+
+        if untransformed_vectors is not None:
+            untransformed_solution = evaluate(args.model + ' (without TTA)', abs_filenames, untransformed_vectors,
+                                              args.solutions)
+
+            print('TTA with {} variants: accuracy gain {:+.4f}, at {:.1f} tiles/s ({:.1f} images/s through the '
+                  'model), against {:.1f} tiles/s without TTA ({:.2f}x slower)'.format(
+                      args.tta, solution.accuracy - untransformed_solution.accuracy, timings.images_per_second,
+                      timings.images_per_second * args.tta, untransformed_timings.images_per_second,
+                      untransformed_timings.images_per_second / timings.images_per_second))
+
+        if args.reference_model:
+            # With the same TTA as --model, so that the two are compared like for like.
+            reference_vectors, _, reference_timings, _, _ = run_predictions(args.reference_model, args)
+            print('{}{}: {}'.format(args.reference_model,
+                                    ' (with TTA over {} variants)'.format(args.tta) if args.tta > 1 else '',
+                                    reference_timings))
+
+            reference_solution = evaluate(args.reference_model, abs_filenames, reference_vectors, args.solutions)
+
+            print('Accuracy delta: {:+.4f}. Speedup: {:.2f}x'.format(
+                solution.accuracy - reference_solution.accuracy,
+                timings.images_per_second / reference_timings.images_per_second))
+
+
+def run_predictions(model_path, args):
+    predictor = inference.load_predictor(model_path, args.threads)
+    if args.tta > 1:
+        predictor = inference.TTAPredictor(predictor, args.tta)
+
+    if shards.is_sharded(args.dataset_dir):
+        test_generator = shards.ShardReader(args.dataset_dir, args.batch_size, shuffle=False)
+    else:
+        from keras.preprocessing import image
+
+        test_datagen = image.ImageDataGenerator(rescale=1. / 255)
+
+        test_generator = test_datagen.flow_from_directory(
+            args.dataset_dir,
+            target_size=(256, 256),
+            batch_size=args.batch_size,
+            class_mode='categorical',
+            follow_links=True,
+            shuffle=False)
+    steps = math.ceil(len(test_generator.filenames) / args.batch_size)
+
+    if args.tta > 1:
+        first_batches = []
+        prediction_vectors, timings = inference.predict_generator(
+            predictor, keep_first_batches(test_generator, first_batches, UNTRANSFORMED_TIMING_BATCHES + 1), steps)
+        untransformed_vectors = np.concatenate(predictor.untransformed_predictions)
+
+        # Timed once the TTA run is over, so that none of this counts towards the TTA timings.
+        inference.predict_generator(predictor.predictor, iter(first_batches[:1]), 1)
+        timed_batches = first_batches[1:] or first_batches
+        _, untransformed_timings = inference.predict_generator(predictor.predictor, iter(timed_batches),
+                                                               len(timed_batches))
+    else:
+        prediction_vectors, timings = inference.predict_generator(predictor, test_generator, steps)
+        untransformed_vectors, untransformed_timings = None, None
+
+    return prediction_vectors, test_generator.filenames, timings, untransformed_vectors, untransformed_timings
+
+
+def keep_first_batches(generator, batches, count):
+    for batch in generator:
+        if len(batches) < count:
+            batches.append(batch)
+        yield batch
+
+
+def write_raster(raster_path, paths, prediction_vectors, project_ids):
+    project_index = None
+    if project_ids:
+        import mapswipe
+        project_index = mapswipe.get_project_index()
+
+    raster, outside_count = prediction_raster.write_raster(
+        raster_path, prediction_raster.quadkeys_of_paths(paths), prediction_vectors,
+        inference.CLASS_NAMES, project_index, project_ids)
+
+    level_shape = raster.metadata['levels'][0]['shape']
+    print('Wrote a {}x{} tile raster with {} levels to {}'.format(
+        level_shape[1], level_shape[0], raster.level_count, os.path.abspath(raster_path)))
+    if outside_count:
+        print('{} predictions were outside the raster'.format(outside_count))
+
+
+def evaluate(model_path, paths, prediction_vectors, solutions_path):
+    import mapswipe_analysis
+
+    solution = mapswipe_analysis.Solution(mapswipe_analysis.ground_truth_solutions_file_to_map(solutions_path),
+                                          mapswipe_analysis.predictions_to_map(paths, prediction_vectors))
+
+    print('{}: accuracy {:.4f} ({})'.format(model_path, solution.accuracy, ', '.join(
+        '{}: {:.4f}'.format(name, accuracy)
+        for name, accuracy in zip(inference.CLASS_NAMES, solution.category_accuracies))))
+
+    return solution
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Checks the on-disk HTTP cache against fixture_server.py, offline. Run it with "python3 test_http_cache.py" (or pytest).
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import fixture_server
+import http_cache
+
+PROJECTS_URL = 'http://api.mapswipe.org/projects.json'
+
+
+class HttpCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.fixtures_dir = os.path.join(self.temp_dir, 'fixtures')
+        self.write_fixture(b'{"1": {"name": "a"}}')
+
+        self.server = fixture_server.start(self.fixtures_dir)
+
+        # Record the status of every response, to tell a conditional request from a full one.
+        self.statuses = []
+        statuses = self.statuses
+
+        class RecordingRequestHandler(self.server.RequestHandlerClass):
+            def send_response(self, code, message=None):
+                statuses.append(code)
+                super().send_response(code, message)
+
+        self.server.RequestHandlerClass = RecordingRequestHandler
+
+        self.original_cache_path = http_cache.cache_path
+        http_cache.cache_path = os.path.join(self.temp_dir, 'http_cache')
+        self.original_fixtures_url = os.environ.get(http_cache.FIXTURES_ENVIRONMENT_VARIABLE)
+        os.environ[http_cache.FIXTURES_ENVIRONMENT_VARIABLE] = fixture_server.server_url(self.server)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+        http_cache.cache_path = self.original_cache_path
+        if self.original_fixtures_url is None:
+            del os.environ[http_cache.FIXTURES_ENVIRONMENT_VARIABLE]
+        else:
+            os.environ[http_cache.FIXTURES_ENVIRONMENT_VARIABLE] = self.original_fixtures_url
+
+        shutil.rmtree(self.temp_dir)
+
+    def write_fixture(self, body, mtime=None):
+        path = fixture_server.fixture_path(self.fixtures_dir, PROJECTS_URL)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'wb') as f:
+            f.write(body)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def fetched_at(self):
+        with open(http_cache._cache_entry_paths(PROJECTS_URL)[1]) as f:
+            return json.load(f)['fetched_at']
+
+    def test_fresh_fetch(self):
+        self.assertEqual(http_cache.fetch(PROJECTS_URL), b'{"1": {"name": "a"}}')
+        self.assertEqual(self.statuses, [200])
+
+        # Within the TTL, the cached copy is used without asking the server.
+        self.write_fixture(b'{"2": {"name": "b"}}', time.time() + 10)
+        self.assertEqual(http_cache.fetch(PROJECTS_URL), b'{"1": {"name": "a"}}')
+        self.assertEqual(self.statuses, [200])
+
+    def test_revalidation_when_unchanged(self):
+        http_cache.fetch(PROJECTS_URL)
+        fetched_at = self.fetched_at()
+
+        self.assertEqual(http_cache.fetch(PROJECTS_URL, ttl=0), b'{"1": {"name": "a"}}')
+        self.assertEqual(self.statuses, [200, 304])
+
+        # The cached copy is good for another TTL.
+        self.assertGreater(self.fetched_at(), fetched_at)
+        http_cache.fetch(PROJECTS_URL)
+        self.assertEqual(self.statuses, [200, 304])
+
+    def test_ttl_expiry_when_changed(self):
+        http_cache.fetch(PROJECTS_URL)
+        self.write_fixture(b'{"2": {"name": "b"}}', time.time() + 10)
+
+        self.assertEqual(http_cache.fetch(PROJECTS_URL, ttl=0), b'{"2": {"name": "b"}}')
+        self.assertEqual(self.statuses, [200, 200])
+
+        # The new copy is the one that's cached.
+        self.assertEqual(http_cache.fetch(PROJECTS_URL), b'{"2": {"name": "b"}}')
+        self.assertEqual(self.statuses, [200, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Checks that "mapswipe-ml <command> --help" stays quick: every subcommand has to print its help within
+# IMPORT_BUDGET_SECONDS, without importing any of the heavy dependencies. Run it with "python3 test_import_time.py" (or
+# pytest). Each command runs in a fresh interpreter, and the time measured is from running mapswipe-ml to --help
+# exiting, so interpreter start-up isn't counted.
+
+import importlib.machinery
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+IMPORT_BUDGET_SECONDS = 1.0
+
+HEAVY_MODULES = ['keras', 'tensorflow', 'sklearn', 'pandas', 'IPython']
+
+ENTRY_POINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mapswipe-ml')
+
+MEASURE = '''
+import json, runpy, sys, time
+sys.argv = [{entry_point!r}, {command!r}, '--help']
+start = time.perf_counter()
+try:
+    runpy.run_path({entry_point!r}, run_name='__main__')
+except SystemExit:
+    pass
+seconds = time.perf_counter() - start
+sys.stdout.write('\\n' + json.dumps({{'seconds': seconds, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}) + '\\n')
+'''
+
+
+def load_subcommands():
+    loader = importlib.machinery.SourceFileLoader('mapswipe_ml', ENTRY_POINT)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+
+    return sorted(module.SUBCOMMANDS)
+
+
+def measure(command):
+    output = subprocess.run([sys.executable, '-c', MEASURE.format(entry_point=ENTRY_POINT, command=command,
+                                                                  heavy=HEAVY_MODULES)],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_help_is_quick_and_light(self):
+        for command in load_subcommands():
+            with self.subTest(command=command):
+                result = measure(command)
+
+                self.assertEqual(result['heavy'], [], '"mapswipe-ml {} --help" imported {}'.format(
+                    command, ', '.join(result['heavy'])))
+                self.assertLess(result['seconds'], IMPORT_BUDGET_SECONDS,
+                                '"mapswipe-ml {} --help" took {:.2f}s (budget: {}s)'.format(
+                                    command, result['seconds'], IMPORT_BUDGET_SECONDS))
+
+
+if __name__ == '__main__':
+    unittest.main()
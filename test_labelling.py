@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Checks that labelling.DEFAULT_RULE labels tiles exactly as generate_dataset.py always has, for every combination of up
+# to MAX_VOTES votes of each type. Run it with "python3 test_labelling.py" (or pytest).
+
+import itertools
+import unittest
+
+import numpy as np
+
+import labelling
+
+MAX_VOTES = 12
+
+
+def original_rule(yes_count, maybe_count, bad_imagery_count):
+    # As it was hard-coded in generate_dataset.classify_project_tiles.
+    built_floor = 1
+    bad_imagery_floor = 1
+
+    if yes_count >= built_floor and maybe_count == 0 and bad_imagery_count == 0:
+        return 'built'
+    elif yes_count == 0 and maybe_count == 0 and bad_imagery_count >= bad_imagery_floor:
+        return 'bad_imagery'
+    return None
+
+
+def vote_grid():
+    counts = np.array(list(itertools.product(range(MAX_VOTES + 1), repeat=3)), dtype=np.int32)
+    quadkeys = np.array(['{}-{}-{}'.format(*row) for row in counts.tolist()], dtype=str)
+
+    return labelling.VoteTable(quadkeys, counts[:, 0], counts[:, 1], counts[:, 2])
+
+
+class DefaultRuleTest(unittest.TestCase):
+    def test_matches_original_rule(self):
+        votes = vote_grid()
+        built, bad_imagery = labelling.classify(votes, labelling.DEFAULT_RULE)
+
+        expected_built, expected_bad_imagery = set(), set()
+        for quadkey, yes_count, maybe_count, bad_imagery_count in zip(
+                votes.quadkeys.tolist(), votes.yes_counts.tolist(), votes.maybe_counts.tolist(),
+                votes.bad_imagery_counts.tolist()):
+            label = original_rule(yes_count, maybe_count, bad_imagery_count)
+            if label == 'built':
+                expected_built.add(quadkey)
+            elif label == 'bad_imagery':
+                expected_bad_imagery.add(quadkey)
+
+        self.assertEqual(built, expected_built)
+        self.assertEqual(bad_imagery, expected_bad_imagery)
+
+    def test_class_sizes_match_original_rule(self):
+        # class_sizes() evaluates in chunks, so make sure that the chunks add up too.
+        votes = vote_grid()
+        original_chunk_size = labelling.CHUNK_SIZE
+        labelling.CHUNK_SIZE = 100
+        try:
+            built_sizes, bad_imagery_sizes = labelling.class_sizes(votes, [labelling.parse_rule('default')])
+        finally:
+            labelling.CHUNK_SIZE = original_chunk_size
+
+        self.assertEqual(built_sizes.tolist(), [MAX_VOTES])
+        self.assertEqual(bad_imagery_sizes.tolist(), [MAX_VOTES])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+
+#   Copyright 2017 Philip Tromans
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Keeps the tile cache (~/.mapswipe/tiles) within a size budget. The size and last access time of every tile is kept in a
+# SQLite index, so that we never have to stat millions of files to decide what to delete. When the cache is over budget,
+# the least recently used tiles are deleted, apart from:
+#   - tiles used by a registered dataset (a dataset directory, a solutions.csv or a distributed_generate.py manifest),
+#     for as long as the dataset still exists.
+#   - zero-byte "no tile" markers, which take up no space, and save us from asking Bing Maps for them again.
+
+import argparse
+import atexit
+import csv
+import os
+import sqlite3
+import threading
+import time
+
+import mapswipe
+
+index_path = os.path.join(mapswipe.working_dir_path, 'tile_index.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tiles (
+    quadkey TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tiles_by_last_access ON tiles (last_access) WHERE size > 0;
+CREATE TABLE IF NOT EXISTS manifests (path TEXT PRIMARY KEY);
+'''
+
+# When evicting, we go below the budget by this much, so that we're not evicting a few tiles at a time on every run.
+EVICTION_HEADROOM = 0.1
+
+# Tile reads recorded with touch() are written to the index at least this often.
+TOUCH_FLUSH_INTERVAL = 10.0
+TOUCH_FLUSH_EVERY = 1000
+
+_touched = {}
+_touched_lock = threading.Lock()
+_touched_flushed_at = time.monotonic()
+
+
+class TileCacheIndex(object):
+    def __init__(self, path=None, flush_every=1000):
+        self.path = path or index_path
+        self.flush_every = flush_every
+        self._pending = {}
+
+        parent_path = os.path.dirname(self.path)
+        if not os.path.isdir(parent_path):
+            os.makedirs(parent_path)
+
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def record_access(self, quadkey, size):
+        # Accesses are buffered, so that this is cheap enough to call for every tile we look at.
+        self.record_accesses({quadkey: (size, int(time.time()))})
+
+    def record_accesses(self, accesses):
+        # accesses maps quadkeys to (size, last access time) pairs.
+        self._pending.update(accesses)
+
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany('INSERT OR REPLACE INTO tiles (quadkey, size, last_access) VALUES (?, ?, ?)',
+                                    ((quadkey, size, last_access)
+                                     for quadkey, (size, last_access) in self._pending.items()))
+        self.connection.execute('COMMIT')
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def rebuild(self):
+        # The one time that we do walk the whole cache: to index tiles that were downloaded before the index existed.
+        # Their modification time is the best guess we have at when they were last used.
+        self.flush()
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.execute('DELETE FROM tiles')
+
+        tile_count = 0
+        if os.path.isdir(mapswipe.tile_cache_path):
+            for subdir in os.scandir(mapswipe.tile_cache_path):
+                if not subdir.is_dir():
+                    continue
+
+                rows = []
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith('.jpg'):
+                        stat = entry.stat()
+                        rows.append((entry.name[:-len('.jpg')], stat.st_size, int(stat.st_mtime)))
+
+                self.connection.executemany('INSERT INTO tiles (quadkey, size, last_access) VALUES (?, ?, ?)', rows)
+                tile_count += len(rows)
+
+        self.connection.execute('COMMIT')
+        return tile_count
+
+    def summary(self):
+        self.flush()
+        return self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size = 0), 0) FROM tiles').fetchone()
+
+    def register_manifest(self, path):
+        self.connection.execute('INSERT OR IGNORE INTO manifests (path) VALUES (?)', (os.path.abspath(path),))
+
+    def unregister_manifest(self, path):
+        self.connection.execute('DELETE FROM manifests WHERE path = ?', (os.path.abspath(path),))
+
+    def manifests(self):
+        return [row[0] for row in self.connection.execute('SELECT path FROM manifests ORDER BY path')]
+
+    def pinned_quadkeys(self, forget_deleted=True):
+        pinned = set()
+        for path in self.manifests():
+            if os.path.exists(path):
+                pinned.update(quadkeys_in_manifest(path))
+            elif forget_deleted:
+                # The dataset has been deleted, so it doesn't need its tiles any more.
+                self.unregister_manifest(path)
+
+        return pinned
+
+    def evict(self, max_bytes, dry_run=False):
+        self.flush()
+
+        total_bytes = self.summary()[1]
+        if total_bytes <= max_bytes:
+            return 0, 0
+
+        target_bytes = total_bytes - max_bytes * (1.0 - EVICTION_HEADROOM)
+        pinned = self.pinned_quadkeys(forget_deleted=not dry_run)
+
+        evicted = []
+        evicted_bytes = 0
+        for quadkey, size in self.connection.execute(
+                'SELECT quadkey, size FROM tiles WHERE size > 0 ORDER BY last_access').fetchall():
+            if evicted_bytes >= target_bytes:
+                break
+            if quadkey in pinned:
+                continue
+
+            evicted.append(quadkey)
+            evicted_bytes += size
+
+        if not dry_run:
+            for quadkey in evicted:
+                try:
+                    os.remove(mapswipe.get_tile_path(quadkey, make_directories=False))
+                except FileNotFoundError:
+                    pass
+
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('DELETE FROM tiles WHERE quadkey = ?', ((quadkey,) for quadkey in evicted))
+            self.connection.execute('COMMIT')
+
+        return len(evicted), evicted_bytes
+
+
+def touch(quadkey, size):
+    # Records that a tile has been read, for code that doesn't have a TileCacheIndex of its own (serve.py, sprite sheets).
+    # Safe to call from any thread: reads are buffered, and written with a short-lived connection of their own.
+    global _touched_flushed_at
+
+    with _touched_lock:
+        _touched[quadkey] = (size, int(time.time()))
+        if len(_touched) < TOUCH_FLUSH_EVERY and time.monotonic() - _touched_flushed_at < TOUCH_FLUSH_INTERVAL:
+            return
+        _touched_flushed_at = time.monotonic()
+
+    flush_touched()
+
+
+def flush_touched():
+    with _touched_lock:
+        pending = dict(_touched)
+        _touched.clear()
+
+    if not pending:
+        return
+
+    try:
+        tile_index = TileCacheIndex()
+        tile_index.record_accesses(pending)
+        tile_index.close()
+    except sqlite3.Error:
+        # Try again next time, without losing any reads that have been recorded since.
+        with _touched_lock:
+            for quadkey, access in pending.items():
+                _touched.setdefault(quadkey, access)
+
+
+atexit.register(flush_touched)
+
+
+def quadkeys_in_manifest(path):
+    if os.path.isdir(path):
+        # A dataset directory, full of symlinks into the tile cache.
+        for dir_path, dir_names, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.endswith('.jpg'):
+                    yield filename[:-len('.jpg')]
+        return
+
+    with open(path, newline='') as f:
+        rows = csv.reader(f)
+        header = next(rows, None)
+        if header is None:
+            return
+
+        # distributed_generate.py manifests have a header with a quadkey column. solutions.csv has no header, and the
+        # quadkey comes first.
+        if 'quadkey' in header:
+            column = header.index('quadkey')
+        else:
+            column = 0
+            yield header[column]
+
+        for row in rows:
+            yield row[column]
+
+
+def parse_size(size):
+    units = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+    size = size.strip().lower().rstrip('b')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('rebuild', help='Index every tile in the tile cache (only needed once)')
+    subparsers.add_parser('status', help='Summarise the tile cache')
+
+    evict_parser = subparsers.add_parser('evict', help='Delete the least recently used tiles')
+    evict_parser.add_argument('max_size', metavar='<max_size>', type=parse_size,
+                              help='The size to shrink the tile cache to, e.g. 50G')
+    evict_parser.add_argument('--dry-run', '-n', action='store_true', help='Only report what would be deleted')
+
+    pin_parser = subparsers.add_parser('pin', help='Never evict the tiles used by these datasets')
+    pin_parser.add_argument('paths', metavar='<dataset>', nargs='+',
+                            help='Dataset directories, solutions.csv files or distributed_generate.py manifests')
+
+    unpin_parser = subparsers.add_parser('unpin', help='Stop pinning the tiles used by these datasets')
+    unpin_parser.add_argument('paths', metavar='<dataset>', nargs='+')
+
+    args = parser.parse_args(argv)
+
+    tile_index = TileCacheIndex()
+
+    if args.command == 'rebuild':
+        print('Indexed {} tiles'.format(tile_index.rebuild()))
+    elif args.command == 'status':
+        tile_count, total_bytes, no_tile_count = tile_index.summary()
+        print('{} tiles ({} "no tile" markers), {:.1f}MB'.format(tile_count, no_tile_count, total_bytes / 2 ** 20))
+        for path in tile_index.manifests():
+            print('Pinned: {}{}'.format(path, '' if os.path.exists(path) else ' (deleted)'))
+    elif args.command == 'evict':
+        evicted_count, evicted_bytes = tile_index.evict(args.max_size, args.dry_run)
+        print('{} {} tiles ({:.1f}MB)'.format('Would evict' if args.dry_run else 'Evicted', evicted_count,
+                                             evicted_bytes / 2 ** 20))
+    elif args.command == 'pin':
+        for path in args.paths:
+            tile_index.register_manifest(path)
+    elif args.command == 'unpin':
+        for path in args.paths:
+            tile_index.unregister_manifest(path)
+
+    tile_index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,8 @@
 
 import argparse
 import os
-import pickle
 
-from keras import applications, callbacks, layers, metrics, models, optimizers, preprocessing
-from keras.preprocessing import image
+import shards
 
 
 def step_count(sample_count, batch_size):
@@ -31,7 +29,7 @@ def step_count(sample_count, batch_size):
                 return sample_count // batch_size
 
 
-def main():
+def main(argv=None):
         parser = argparse.ArgumentParser()
         parser.add_argument(
             '--dataset-dir', '-i', metavar='<dataset_dir>', required=True,
@@ -52,8 +50,22 @@ def main():
                             type=int, help='The number of training epochs to complete.')
         parser.add_argument('--batch-size', '-b', required=False,
                             default=64, type=int, help='The training batch size')
+        parser.add_argument('--start-weights', '-w', metavar='<weights_file>', required=False, default=None,
+                            help='A .weights.npz checkpoint to load into the model before training (e.g. to resume an interrupted run)')
+        parser.add_argument(
+            '--keep-checkpoints', '-k', required=False, default=3, type=int,
+                            help='The number of checkpoints to keep, by validation loss (the latest checkpoint is always kept too). Default: 3')
+        parser.add_argument(
+            '--checkpoint-deltas', required=False, default=False, action='store_true',
+                            help='Store each checkpoint as the difference from the first one, compressed (much smaller when fine tuning)')
+
+        args = parser.parse_args(argv)
 
-        args = parser.parse_args()
+        # Keras takes several seconds to import, so we only do it once we know we've got something to do.
+        from keras import applications, layers, metrics, models, optimizers, preprocessing
+        from keras.preprocessing import image
+
+        import checkpointing
 
         if not args.model_prefix:
                 if not args.start_model:
@@ -86,6 +98,9 @@ def main():
                 model = models.Model(
                     inputs=base_model.input, outputs=predictions)
 
+        if args.start_weights:
+                model.set_weights(checkpointing.load_weights(args.start_weights))
+
         if args.fine_tune:
                 for layer in model.layers[0:-3]:
                         layer.trainable = False
@@ -100,32 +115,42 @@ def main():
                     optimizer=optimizers.SGD(lr=0.0001, momentum=0.9),
                              loss='categorical_crossentropy', metrics=[metrics.categorical_accuracy])
 
-        train_datagen = preprocessing.image.ImageDataGenerator(
-            rescale=1. / 255,  # makes all picture values between 0 and 1
-                horizontal_flip=True,
-                vertical_flip=True)
-
-        test_datagen = preprocessing.image.ImageDataGenerator(rescale=1. / 255)
+        if shards.is_sharded(os.path.join(args.dataset_dir, 'train')):
+                train_generator = shards.ShardReader(
+                    os.path.join(args.dataset_dir, 'train'), args.batch_size, shuffle=True,
+                        horizontal_flip=True, vertical_flip=True)
 
-        train_generator = train_datagen.flow_from_directory(
-            os.path.join(args.dataset_dir, 'train'),
-                target_size=(256, 256),
-                batch_size=args.batch_size,
-                class_mode='categorical',
-                follow_links=True
-        )
-
-        validation_generator = test_datagen.flow_from_directory(
-            os.path.join(args.dataset_dir, 'valid'),
-                target_size=(256, 256),
-                batch_size=args.batch_size,
-                class_mode='categorical',
-                follow_links=True)
-
-        callback = callbacks.ModelCheckpoint(
-            os.path.join(args.output_dir, args.model_prefix + ".{epoch:02d}-{val_loss:.3f}-{val_categorical_accuracy:.3f}.hdf5"), monitor='val_loss', verbose=0, save_best_only=False, save_weights_only=False, mode='auto', period=1)
-
-        history = model.fit_generator(
+                validation_generator = shards.ShardReader(
+                    os.path.join(args.dataset_dir, 'valid'), args.batch_size, shuffle=False)
+        else:
+                train_datagen = preprocessing.image.ImageDataGenerator(
+                    rescale=1. / 255,  # makes all picture values between 0 and 1
+                        horizontal_flip=True,
+                        vertical_flip=True)
+
+                test_datagen = preprocessing.image.ImageDataGenerator(rescale=1. / 255)
+
+                train_generator = train_datagen.flow_from_directory(
+                    os.path.join(args.dataset_dir, 'train'),
+                        target_size=(256, 256),
+                        batch_size=args.batch_size,
+                        class_mode='categorical',
+                        follow_links=True
+                )
+
+                validation_generator = test_datagen.flow_from_directory(
+                    os.path.join(args.dataset_dir, 'valid'),
+                        target_size=(256, 256),
+                        batch_size=args.batch_size,
+                        class_mode='categorical',
+                        follow_links=True)
+
+        # Checkpoints (and the fit history) are written in the background, and the best one so far is also saved as a
+        # full model.
+        callback = checkpointing.AsyncCheckpointManager(
+            args.output_dir, args.model_prefix, keep_top_k=args.keep_checkpoints, store_deltas=args.checkpoint_deltas)
+
+        model.fit_generator(
             train_generator,
                 steps_per_epoch=step_count(
                     train_generator.samples, args.batch_size),
@@ -136,7 +161,6 @@ def main():
                 callbacks=[callback]
         )
 
-        with open(os.path.join(args.output_dir, args.model_prefix + "_fit_history.pickle"), "wb") as history_file:
-                pickle.dump(history.history, history_file)
 
-main()
+if __name__ == '__main__':
+    main()